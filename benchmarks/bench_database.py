@@ -0,0 +1,96 @@
+"""
+Микробенчмарк database.py: соединение на каждый запрос (как было раньше)
+против одного долгоживущего соединения в режиме WAL.
+
+Запуск из корня проекта: python benchmarks/bench_database.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import aiosqlite
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database as db  # noqa: E402
+
+USERS = 200
+ORDERS = 2000
+QUERIES = 3000
+WRITES = 500
+
+
+async def _fill(path: str):
+    await db.connect_db(path)
+    await db.init_db()
+    for user_id in range(USERS):
+        await db.add_user(user_id, f"user{user_id}")
+    for i in range(ORDERS):
+        event = {'ID': i % 20, 'ShortName': f"event{i % 20}", 'datetime_obj': datetime(2025, 1, 1), 'Price': 1000}
+        await db.create_order(i % USERS, event, 1000)
+    await db.close_db()
+
+
+async def _per_call_reads(path: str) -> float:
+    """Старый подход: новое соединение (и новый поток aiosqlite) на каждый запрос."""
+    started = time.perf_counter()
+    for i in range(QUERIES):
+        async with aiosqlite.connect(path) as conn:
+            cursor = await conn.execute("SELECT * FROM orders WHERE id = ?", (i % ORDERS + 1,))
+            await cursor.fetchone()
+    return QUERIES / (time.perf_counter() - started)
+
+
+async def _per_call_writes(path: str) -> float:
+    started = time.perf_counter()
+    for i in range(WRITES):
+        async with aiosqlite.connect(path) as conn:
+            await conn.execute("UPDATE users SET loyalty_visits = loyalty_visits + 1 WHERE user_id = ?", (i % USERS,))
+            await conn.commit()
+    return WRITES / (time.perf_counter() - started)
+
+
+async def _persistent_reads(path: str) -> float:
+    await db.connect_db(path)
+    started = time.perf_counter()
+    for i in range(QUERIES):
+        await db.get_order_by_id(i % ORDERS + 1)
+    elapsed = time.perf_counter() - started
+    await db.close_db()
+    return QUERIES / elapsed
+
+
+async def _persistent_writes(path: str) -> float:
+    await db.connect_db(path)
+    started = time.perf_counter()
+    for i in range(WRITES):
+        await db.adjust_loyalty(i % USERS, 1)
+    elapsed = time.perf_counter() - started
+    await db.close_db()
+    return WRITES / elapsed
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        await _fill(path)
+
+        # "До": журнал по умолчанию (DELETE) и synchronous = FULL
+        async with aiosqlite.connect(path) as conn:
+            await conn.execute("PRAGMA journal_mode = DELETE")
+        before_reads = await _per_call_reads(path)
+        before_writes = await _per_call_writes(path)
+
+        # "После": connect_db() включает WAL и остальные настройки
+        after_reads = await _persistent_reads(path)
+        after_writes = await _persistent_writes(path)
+
+    print(f"{'':<28}{'до':>12}{'после':>12}{'ускорение':>12}")
+    print(f"{'чтения, запросов/с':<28}{before_reads:>12.0f}{after_reads:>12.0f}{after_reads / before_reads:>11.1f}x")
+    print(f"{'записи, транзакций/с':<28}{before_writes:>12.0f}{after_writes:>12.0f}{after_writes / before_writes:>11.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+"""
+Бенчмарк индекса заказов (миграция 5): check_if_ticket_exists и get_user_paid_orders
+на нескольких сотнях тысяч синтетических заказов без индекса и с ним.
+
+Запуск из корня проекта: python benchmarks/bench_orders_indexes.py
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database as db  # noqa: E402
+
+ORDERS = 300_000
+USERS = 20_000
+EVENTS = 500
+QUERIES = 2000
+
+
+async def _fill():
+    random.seed(1)
+    conn = db._connection()
+    await conn.executemany(
+        "INSERT INTO users (user_id, username) VALUES (?, ?)",
+        [(user_id, f"user{user_id}") for user_id in range(USERS)]
+    )
+    statuses = ['paid'] * 7 + ['pending', 'cancelled']
+    await conn.executemany(
+        "INSERT INTO orders (user_id, event_id, status, amount, created_at) VALUES (?, ?, ?, 1000, '2025-01-01')",
+        [(random.randrange(USERS), random.randrange(EVENTS), random.choice(statuses)) for _ in range(ORDERS)]
+    )
+    await conn.commit()
+
+
+async def _measure(label: str) -> tuple[float, float]:
+    random.seed(2)
+    probes = [(random.randrange(USERS), random.randrange(EVENTS)) for _ in range(QUERIES)]
+
+    started = time.perf_counter()
+    for user_id, event_id in probes:
+        await db.check_if_ticket_exists(user_id, event_id)
+    exists_qps = QUERIES / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for user_id, _ in probes:
+        await db.get_user_paid_orders(user_id)
+    paid_qps = QUERIES / (time.perf_counter() - started)
+
+    plan = await db._fetchall(
+        "EXPLAIN QUERY PLAN SELECT 1 FROM orders WHERE user_id = ? AND event_id = ? AND status = 'paid' LIMIT 1", (1, 1)
+    )
+    print(f"{label}: план check_if_ticket_exists — {plan[0][-1]}")
+    return exists_qps, paid_qps
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        await db.connect_db(os.path.join(tmp, "bench.db"))
+        await db.init_db()
+        await _fill()
+
+        # Замер "до" — вообще без индексов по orders: idx_orders_event_status (миграция 10)
+        # подходит под фильтр по event_id и иначе подменил бы полный просмотр таблицы
+        await db._connection().execute("DROP INDEX idx_orders_user_status_event")
+        await db._connection().execute("DROP INDEX idx_orders_event_status")
+        before = await _measure("без индекса")
+        await db._connection().execute(
+            "CREATE INDEX idx_orders_user_status_event ON orders (user_id, status, event_id)"
+        )
+        after = await _measure("с индексом")
+        await db.close_db()
+
+    print(f"\n{ORDERS} заказов, {QUERIES} запросов каждого вида")
+    print(f"{'':<32}{'до':>10}{'после':>10}{'ускорение':>12}")
+    for name, b, a in (("check_if_ticket_exists, зап/с", before[0], after[0]),
+                       ("get_user_paid_orders, зап/с", before[1], after[1])):
+        print(f"{name:<32}{b:>10.0f}{a:>10.0f}{a / b:>11.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
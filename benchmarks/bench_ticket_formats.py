@@ -0,0 +1,44 @@
+"""
+Бенчмарк форматов билета: время кодирования и размер файла для PNG в полном размере
+и для JPEG/WebP с разным качеством и длинной стороной.
+
+Запуск из корня проекта: python benchmarks/bench_ticket_formats.py
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+from services.ticket_generator import TicketRenderer, encode_ticket  # noqa: E402
+
+REPEATS = 5
+TICKET = ("Мастер-класс по керамике: лепим чашки и тарелки своими руками", "Иванова Мария Сергеевна",
+          "14.03.2025 в 19:00", "ул. Павла Андреева, д. 23 с. 12")
+# (формат, качество, длинная сторона; 0 — без уменьшения)
+VARIANTS = [
+    ('PNG', 0, 0),
+    ('JPEG', 85, 0),
+    ('JPEG', 85, 1200),
+    ('JPEG', 75, 800),
+    ('WEBP', 80, 0),
+    ('WEBP', 80, 1200),
+]
+
+
+def main():
+    img = TicketRenderer().render(*TICKET)
+
+    print(f"{'формат':24}{'кодирование, мс':>18}{'размер, КБ':>14}")
+    for output_format, quality, max_size in VARIANTS:
+        started = time.perf_counter()
+        for _ in range(REPEATS):
+            data = encode_ticket(img.copy(), output_format, quality, max_size)
+        elapsed = (time.perf_counter() - started) / REPEATS * 1000
+        title = f"{output_format} q{quality} {max_size or 'полный'}" if quality else f"{output_format} полный"
+        print(f"{title:24}{elapsed:18.1f}{len(data) / 1024:14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Микробенчмарк генерации билетов: шаблон и шрифты загружаются заново на каждый билет
+(как было раньше) против одного TicketRenderer с заранее загруженными ресурсами.
+Меряется отрисовка и отдельно отрисовка вместе с сохранением в PNG.
+
+Запуск из корня проекта: python benchmarks/bench_ticket_render.py
+"""
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+from services.ticket_generator import TicketRenderer  # noqa: E402
+
+TICKETS = 30
+TICKET = ("Мастер-класс по керамике: лепим чашки и тарелки своими руками", "Иванова Мария Сергеевна",
+          "14.03.2025 в 19:00", "ул. Павла Андреева, д. 23 с. 12")
+
+
+def _measure(get_renderer, encode: bool) -> float:
+    started = time.perf_counter()
+    for _ in range(TICKETS):
+        img = get_renderer().render(*TICKET)
+        if encode:
+            img.save(io.BytesIO(), format="PNG")
+    return TICKETS / (time.perf_counter() - started)
+
+
+def main():
+    renderer = TicketRenderer()
+    rows = []
+    for title, encode in (("отрисовка, билетов/с", False), ("отрисовка + PNG, билетов/с", True)):
+        before = _measure(TicketRenderer, encode)
+        after = _measure(lambda: renderer, encode)
+        rows.append((title, before, after))
+
+    print(f"{'':30}{'до':>10}{'после':>10}{'ускорение':>12}")
+    for title, before, after in rows:
+        print(f"{title:30}{before:10.1f}{after:10.1f}{after / before:11.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,16 @@ import logging
 from handlers import feedback_handlers
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from config_reader import config
 from handlers import user_handlers, booking_handlers
-from database import init_db
-from utils.scheduler import send_arrival_info
+from database import close_db, connect_db, init_db, verify_loyalty_balances
+from services import google_sheets as gs
+from services import sheets_gateway
+from services.sheets_outbox import run_sheet_writes_flusher
+from services import ticket_generator
+from utils.scheduler import rebuild_jobs, scheduler, setup_scheduler
 
-# --- Глобальный объект шедулера ---
-scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+SHEETS_STARTUP_TIMEOUT = 15  # секунд на первичную загрузку данных из Google Sheets
 
 async def main():
     logging.basicConfig(level=logging.INFO)
@@ -18,18 +20,58 @@ async def main():
     bot = Bot(token=config.bot_token.get_secret_value(), default=DefaultBotProperties(parse_mode="HTML"))
     dp = Dispatcher()
 
+    await connect_db()
     await init_db()
 
+    mismatches = await verify_loyalty_balances()
+    if mismatches:
+        logging.warning(f"Балансы лояльности расходятся с журналом у {len(mismatches)} пользователей: {mismatches[:10]}")
+
+    # Билеты рисуются в пуле процессов; каждый процесс загружает шаблон и шрифты один раз при старте
+    ticket_generator.configure_output(config.ticket_format, config.ticket_quality, config.ticket_max_size)
+    await ticket_generator.start_render_pool(config.ticket_render_workers)
+
+    # Афишу сразу поднимаем из локальной копии в SQLite, чтобы бот отвечал, даже если Google недоступен
+    await gs.load_events_cache_from_db()
+
+    # Загружаем афишу, промокоды и список клиентов до начала приема апдейтов и дальше обновляем их в фоне.
+    # Если Google Sheets недоступен, не ждем его дольше SHEETS_STARTUP_TIMEOUT секунд
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(gs.refresh_events_cache(), gs.refresh_promo_index(), gs.reconcile_known_clients()),
+            timeout=SHEETS_STARTUP_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        logging.warning("Google Sheets не ответил при запуске, данные подгрузятся фоновым обновлением")
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке данных из Google Sheets при запуске: {e}")
+    # Старые заказы без снимка мероприятия заполняем из загруженной афиши
+    await gs.backfill_order_snapshots()
+    events_refresher = asyncio.create_task(gs.run_events_cache_refresher())
+    promo_refresher = asyncio.create_task(gs.run_promo_index_refresher())
+    # Очередь записей в Google Sheets выгружается в фоне
+    sheet_writes_flusher = asyncio.create_task(run_sheet_writes_flusher())
+
     dp.include_router(user_handlers.router)
     dp.include_router(booking_handlers.router)
     dp.include_router(feedback_handlers.router)
 
+    # Задачи напоминаний лежат в SQLite; недостающие восстанавливаем по оплаченным заказам
+    setup_scheduler(bot)
     scheduler.start()
+    await rebuild_jobs()
 
     await bot.delete_webhook(drop_pending_updates=True)
     try:
         await dp.start_polling(bot)
     finally:
+        events_refresher.cancel()
+        promo_refresher.cancel()
+        sheet_writes_flusher.cancel()
+        scheduler.shutdown(wait=False)
+        sheets_gateway.shutdown()
+        ticket_generator.shutdown_render_pool()
+        await close_db()
         await bot.session.close()
 
 if __name__ == "__main__":
@@ -11,5 +11,16 @@ class Settings(BaseSettings):
     channel_id: int
     channel_username: str
 
+    # Сколько потоков одновременно обращаются к Google Sheets
+    sheets_max_workers: int = 4
+    # Квота Sheets API (запросов в минуту), которую бот не должен превышать
+    sheets_quota_per_minute: int = 60
+    # Сколько процессов рисуют билеты (0 — по числу ядер)
+    ticket_render_workers: int = 0
+    # Формат билетов (JPEG, WEBP или PNG), качество для JPEG/WebP и длинная сторона в пикселях (0 — как в шаблоне)
+    ticket_format: str = "JPEG"
+    ticket_quality: int = 85
+    ticket_max_size: int = 1200
+
 # Создаем экземпляр настроек, который будет использоваться в других файлах
 config = Settings()
\ No newline at end of file
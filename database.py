@@ -1,12 +1,134 @@
+import asyncio
 import aiosqlite
+import json
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 DB_NAME = 'bot_database.db'
 
+# Два долгоживущих соединения на все приложение: их открывает connect_db() при старте
+# бота и закрывает close_db() при остановке. Через _db идут транзакции записи, через
+# _read_db — чтения (_fetchone/_fetchall): в режиме WAL читатель не ждет писателя и видит
+# только закоммиченные данные, а не чужую транзакцию, которая еще может откатиться.
+# Соединения держат кэш подготовленных запросов, поэтому одинаковые запросы не компилируются заново.
+_db: aiosqlite.Connection | None = None
+_read_db: aiosqlite.Connection | None = None
+# Запись идет через одно соединение, поэтому транзакции выполняются по очереди
+_write_lock = asyncio.Lock()
 
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('''
+# LRU-кэш строк users (в строке есть и счетчик лояльности). Заполняется при чтении,
+# а каждая функция, меняющая пользователя, после своей транзакции выбрасывает его из кэша.
+USER_CACHE_SIZE = 2000
+_MISSING = object()
+_user_cache: OrderedDict = OrderedDict()
+_user_cache_stats = {'hits': 0, 'misses': 0}
+# Растет при каждой инвалидации и по завершении каждой транзакции (коммитом или откатом):
+# строка, прочитанная до изменения или во время чужой транзакции, в кэш не попадет
+_user_cache_generation = 0
+
+
+async def _open(path: str) -> aiosqlite.Connection:
+    db = await aiosqlite.connect(path, cached_statements=256)
+    # Строки доступны и по индексу, и по имени столбца: order[2] и order['event_id']
+    db.row_factory = aiosqlite.Row
+    await db.execute("PRAGMA cache_size = -16000")  # ~16 МБ кэша страниц
+    await db.execute("PRAGMA temp_store = MEMORY")
+    await db.execute("PRAGMA busy_timeout = 5000")
+    return db
+
+
+async def connect_db(path: str = DB_NAME):
+    """Открывает соединения с базой и настраивает их под нагрузку бота."""
+    global _db, _read_db
+    _db = await _open(path)
+    # WAL: чтения не блокируются записью, а коммит не требует перезаписи всей страницы журнала
+    await _db.execute("PRAGMA journal_mode = WAL")
+    # В режиме WAL NORMAL безопасен при падении процесса и делает fsync только на чекпоинтах
+    await _db.execute("PRAGMA synchronous = NORMAL")
+    # Соединение для чтений открывается после перевода базы в WAL и ничего не пишет
+    _read_db = await _open(path)
+    await _read_db.execute("PRAGMA query_only = ON")
+
+
+async def close_db():
+    global _db, _read_db
+    for connection in (_read_db, _db):
+        if connection is not None:
+            await connection.close()
+    _db = _read_db = None
+    _user_cache.clear()
+
+
+def _connection() -> aiosqlite.Connection:
+    if _db is None:
+        raise RuntimeError("База данных не подключена: сначала вызовите connect_db()")
+    return _db
+
+
+def _read_connection() -> aiosqlite.Connection:
+    if _read_db is None:
+        raise RuntimeError("База данных не подключена: сначала вызовите connect_db()")
+    return _read_db
+
+
+@asynccontextmanager
+async def _transaction():
+    """Выполняет блок в одной транзакции: коммит при успехе, откат при ошибке."""
+    global _user_cache_generation
+    async with _write_lock:
+        db = _connection()
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        finally:
+            # Строка, прочитанная до коммита, могла устареть: в кэш она не попадет
+            _user_cache_generation += 1
+
+
+async def _fetchone(query: str, params=()):
+    rows = await _read_connection().execute_fetchall(query, params)
+    return rows[0] if rows else None
+
+
+async def _fetchall(query: str, params=()):
+    return list(await _read_connection().execute_fetchall(query, params))
+
+
+def _forget_users(*user_ids):
+    """Выбрасывает пользователей из кэша; без аргументов очищает кэш целиком."""
+    global _user_cache_generation
+    _user_cache_generation += 1
+    if not user_ids:
+        _user_cache.clear()
+    for user_id in user_ids:
+        _user_cache.pop(user_id, None)
+
+
+def get_user_cache_stats() -> dict:
+    """Попадания и промахи кэша пользователей и его текущий размер."""
+    return {**_user_cache_stats, 'size': len(_user_cache)}
+
+
+# --- Миграции схемы ---
+# Версия схемы хранится в PRAGMA user_version. init_db() при старте применяет по порядку
+# все миграции с номером больше текущей версии, каждую в своей транзакции.
+# Шаг миграции — SQL-запрос или async-функция, принимающая соединение.
+# Уже выпущенные миграции не меняем: новые изменения схемы — только новой миграцией в конце списка.
+async def _add_column(db, table: str, column: str, definition: str):
+    """Добавляет столбец, если его еще нет (его могла добавить старая версия init_db)."""
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in await cursor.fetchall()]:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+MIGRATIONS = [
+    (1, "базовые таблицы", [
+        '''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -15,8 +137,8 @@ async def init_db():
                 registration_date TEXT,
                 loyalty_visits INTEGER NOT NULL DEFAULT 0
             )
-        ''')
-        await db.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS orders (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -28,12 +150,8 @@ async def init_db():
                 created_at TEXT,
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
-        ''')
-        # Обратите внимание, что мы убрали event_id из FOREIGN KEY для orders,
-        # так как таблицы events больше нет. Если у вас это осталось, удалите.
-        # В вашем коде этого, скорее всего, нет, но на всякий случай проверьте.
-
-        await db.execute('''
+        ''',
+        '''
             CREATE TABLE IF NOT EXISTS feedback (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -41,85 +159,382 @@ async def init_db():
                 feedback_text TEXT,
                 created_at TEXT
             )
-        ''')
-        await db.commit()
+        ''',
+    ]),
+    # Очередь записей в Google Sheets: строки пишутся в одной транзакции с заказом,
+    # а фоновая задача (services/sheets_outbox.py) выгружает их в таблицу пачками
+    (2, "очередь записей в Google Sheets", [
+        '''
+            CREATE TABLE IF NOT EXISTS sheets_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                worksheet TEXT NOT NULL,
+                op TEXT NOT NULL, -- append, append_unique, update, order_status
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TEXT,
+                last_error TEXT,
+                created_at TEXT
+            )
+        ''',
+    ]),
+    # Номер строки заказа в листе 'Заказы' (заполняется после выгрузки заказа в таблицу)
+    (3, "номер строки заказа в листе 'Заказы'", [
+        lambda db: _add_column(db, 'orders', 'sheet_row', 'INTEGER'),
+    ]),
+    # Флаг "клиент уже есть в листе 'Клиенты'", чтобы не искать его там при каждой покупке
+    (4, "флаг выгрузки клиента в лист 'Клиенты'", [
+        lambda db: _add_column(db, 'users', 'sheet_synced', 'INTEGER NOT NULL DEFAULT 0'),
+    ]),
+    # check_if_ticket_exists (user_id, event_id, status) целиком отвечает по индексу,
+    # get_user_paid_orders (user_id, status) берет из него префикс и читает только свои строки
+    (5, "индекс заказов по пользователю и статусу", [
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_status_event ON orders (user_id, status, event_id)",
+    ]),
+    # Снимок мероприятия на момент покупки: экраны билетов и отмены работают без Google Sheets.
+    # Старые заказы заполняет backfill_order_event_snapshots() после первой загрузки афиши
+    (6, "снимок мероприятия в заказе", [
+        lambda db: _add_column(db, 'orders', 'event_name', 'TEXT'),
+        lambda db: _add_column(db, 'orders', 'event_datetime', 'TEXT'),  # ISO, чтобы сортировать в SQL
+        lambda db: _add_column(db, 'orders', 'event_price', 'INTEGER'),
+    ]),
+    # Локальная копия листа 'Афиша' и метки синхронизации (контрольная сумма, время изменения таблицы)
+    (7, "копия афиши и состояние синхронизации", [
+        '''
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY,
+                short_name TEXT,
+                event_datetime TEXT, -- ISO
+                price INTEGER,
+                data TEXT NOT NULL, -- строка листа целиком, JSON
+                in_sheet INTEGER NOT NULL DEFAULT 1,
+                synced_at TEXT
+            )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_events_datetime ON events (event_datetime)",
+        '''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''',
+    ]),
+    # Журнал лояльности: каждое изменение баланса — отдельная строка, users.loyalty_visits
+    # остается материализованным балансом и меняется в той же транзакции.
+    # Текущие балансы переносятся в журнал как начальные ('adjust')
+    (8, "журнал программы лояльности", [
+        '''
+            CREATE TABLE IF NOT EXISTS loyalty_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                order_id INTEGER,
+                kind TEXT NOT NULL, -- earn, redeem, revoke, adjust
+                delta INTEGER NOT NULL,
+                balance_after INTEGER NOT NULL,
+                created_at TEXT
+            )
+        ''',
+        # Сверка балансов суммирует delta по пользователю прямо по индексу
+        "CREATE INDEX IF NOT EXISTS idx_loyalty_events_user ON loyalty_events (user_id, delta)",
+        "CREATE INDEX IF NOT EXISTS idx_loyalty_events_order ON loyalty_events (order_id)",
+        lambda db: db.execute(
+            "INSERT INTO loyalty_events (user_id, kind, delta, balance_after, created_at) "
+            "SELECT user_id, 'adjust', loyalty_visits, loyalty_visits, ? FROM users WHERE loyalty_visits != 0",
+            (datetime.now().isoformat(),)
+        ),
+    ]),
+    # file_id статичных файлов, уже загруженных в Telegram (services/media_cache.py)
+    (9, "кэш file_id для статичных файлов", [
+        '''
+            CREATE TABLE IF NOT EXISTS media_cache (
+                path TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                updated_at TEXT
+            )
+        ''',
+    ]),
+    # Доставка напоминаний по заказам: повторный запуск рассылки продолжает с неотправленных
+    (10, "статус доставки напоминаний", [
+        '''
+            CREATE TABLE IF NOT EXISTS reminder_deliveries (
+                order_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (order_id, kind)
+            )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_orders_event_status ON orders (event_id, status)",
+    ]),
+    # Задачи планировщика переехали в отдельный файл (utils/scheduler.py, JOBS_DB_NAME);
+    # rebuild_jobs() при старте заново заводит задачи по мероприятиям, старые задачи по заказам не нужны
+    (11, "задачи планировщика в отдельной базе", [
+        "DROP TABLE IF EXISTS apscheduler_jobs",
+    ]),
+]
+
+
+async def get_schema_version() -> int:
+    row = await _fetchone("PRAGMA user_version")
+    return row[0]
+
+
+async def init_db():
+    """Применяет недостающие миграции схемы."""
+    version = await get_schema_version()
+    for number, description, steps in MIGRATIONS:
+        if number <= version:
+            continue
+        async with _transaction() as db:
+            # sqlite3 сам открывает транзакцию только перед DML, а CREATE, ALTER и
+            # PRAGMA user_version иначе зафиксировались бы сразу: начинаем ее явно,
+            # чтобы миграция применялась целиком или не применялась вовсе
+            await db.execute("BEGIN")
+            for step in steps:
+                if callable(step):
+                    await step(db)
+                else:
+                    await db.execute(step)
+            await db.execute(f"PRAGMA user_version = {number}")
+        logging.info(f"Схема БД обновлена до версии {number}: {description}")
+
 
 # --- Функции для работы с пользователями ---
 async def add_user(user_id, username):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if await cursor.fetchone() is None:
-            await db.execute(
-                "INSERT INTO users (user_id, username, registration_date) VALUES (?, ?, ?)",
-                (user_id, username, datetime.now().isoformat())
-            )
-            await db.commit()
+    async with _transaction() as db:
+        await db.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, registration_date) VALUES (?, ?, ?)",
+            (user_id, username, datetime.now().isoformat())
+        )
+    _forget_users(user_id)
 
 async def update_user_contacts(user_id, full_name, phone_number):
-     async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         await db.execute(
             "UPDATE users SET full_name = ?, phone_number = ? WHERE user_id = ?",
             (full_name, phone_number, user_id)
         )
-        await db.commit()
+    _forget_users(user_id)
+
+async def get_sheet_synced_user_ids() -> set[int]:
+    """Возвращает ID пользователей, которые уже есть в листе 'Клиенты'."""
+    rows = await _fetchall("SELECT user_id FROM users WHERE sheet_synced = 1")
+    return {row[0] for row in rows}
+
+async def mark_users_sheet_synced(user_ids):
+    """Отмечает пользователей как выгруженных в лист 'Клиенты'."""
+    async with _transaction() as db:
+        await db.executemany("UPDATE users SET sheet_synced = 1 WHERE user_id = ?", [(i,) for i in user_ids])
+    _forget_users(*user_ids)
+
+async def reset_users_sheet_synced(user_ids):
+    """Пересобирает флаг по фактическому содержимому листа 'Клиенты'."""
+    async with _transaction() as db:
+        await db.execute("UPDATE users SET sheet_synced = 0")
+        await db.executemany("UPDATE users SET sheet_synced = 1 WHERE user_id = ?", [(i,) for i in user_ids])
+    _forget_users()
 
 # --- Функции для работы с мероприятиями и заказами ---
-async def create_order(user_id, event_id, amount):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT INTO orders (user_id, event_id, amount, created_at) VALUES (?, ?, ?, ?)",
-            (user_id, event_id, amount, datetime.now().isoformat())
+def _event_snapshot(event: dict) -> tuple:
+    """Поля мероприятия, которые копируются в заказ: ID, название, дата, цена."""
+    return event['ID'], event['ShortName'], event['datetime_obj'].isoformat(), event['Price']
+
+def order_event(order) -> dict | None:
+    """
+    Собирает мероприятие из снимка в заказе в том же виде, что и строки афиши.
+    Возвращает None для старых заказов, которые еще не заполнены.
+    """
+    if order is None or order['event_name'] is None:
+        return None
+    event_dt = datetime.fromisoformat(order['event_datetime'])
+    return {
+        'ID': order['event_id'],
+        'ShortName': order['event_name'],
+        'DateTime': event_dt.strftime('%d.%m.%Y %H:%M'),
+        'Price': order['event_price'],
+        'datetime_obj': event_dt,
+    }
+
+async def backfill_order_event_snapshots() -> int:
+    """
+    Заполняет снимок мероприятия в старых заказах из локальной копии афиши (таблица events).
+    Возвращает число обновленных заказов.
+    """
+    async with _transaction() as db:
+        cursor = await db.execute(
+            "UPDATE orders SET event_name = e.short_name, event_datetime = e.event_datetime, event_price = e.price "
+            "FROM events e WHERE orders.event_id = e.id AND orders.event_name IS NULL"
         )
-        await db.commit()
-        cursor = await db.execute("SELECT last_insert_rowid()")
-        return (await cursor.fetchone())[0]
+        return cursor.rowcount
+
+async def create_order(user_id, event: dict, amount):
+    async with _transaction() as db:
+        cursor = await db.execute(
+            "INSERT INTO orders (user_id, event_id, event_name, event_datetime, event_price, amount, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, *_event_snapshot(event), amount, datetime.now().isoformat())
+        )
+        return cursor.lastrowid
+
+# --- Программа лояльности ---
+# Баланс меняется только через _record_loyalty: она пишет событие в журнал loyalty_events
+# и обновляет users.loyalty_visits в одной транзакции, поэтому сумма delta по пользователю
+# всегда равна его балансу (проверяет verify_loyalty_balances).
+LEGACY_LOYALTY_REFUND = 5  # столько баллов возвращала отмена подарочного билета, оформленного до журнала
+
+async def _record_loyalty(db, user_id: int, kind: str, delta: int | None, order_id=None) -> int:
+    """
+    Меняет баланс внутри открытой транзакции и пишет событие в журнал.
+    delta=None списывает весь баланс. Баланс не уходит ниже нуля, в журнал попадает фактическое изменение.
+    Возвращает новый баланс (0, если пользователя нет).
+    """
+    cursor = await db.execute("SELECT loyalty_visits FROM users WHERE user_id = ?", (user_id,))
+    row = await cursor.fetchone()
+    await cursor.close()
+    if row is None:
+        return 0
+
+    balance = 0 if delta is None else max(row[0] + delta, 0)
+    await db.execute("UPDATE users SET loyalty_visits = ? WHERE user_id = ?", (balance, user_id))
+    await db.execute(
+        "INSERT INTO loyalty_events (user_id, order_id, kind, delta, balance_after, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, order_id, kind, balance - row[0], balance, datetime.now().isoformat())
+    )
+    return balance
 
-async def update_order_status(order_id, payment_id, status):
-     async with aiosqlite.connect(DB_NAME) as db:
+async def _apply_loyalty(db, user_id: int, loyalty_action: str | None, order_id: int) -> int:
+    """
+    Меняет счетчик лояльности за выданный билет и возвращает новое значение:
+    'earn' — +1 за оплаченный билет, 'redeem' — списание всего баланса за бесплатный билет, None — без изменений.
+    """
+    if loyalty_action == 'earn':
+        return await _record_loyalty(db, user_id, 'earn', 1, order_id)
+    if loyalty_action == 'redeem':
+        return await _record_loyalty(db, user_id, 'redeem', None, order_id)
+    cursor = await db.execute("SELECT loyalty_visits FROM users WHERE user_id = ?", (user_id,))
+    row = await cursor.fetchone()
+    await cursor.close()
+    return row[0] if row else 0
+
+async def _revoke_order_loyalty(db, order) -> int:
+    """
+    Отменяет все изменения баланса по заказу (при отмене билета). Для заказов, оформленных
+    до появления журнала, повторяет прежние правила: подарочный билет возвращает баллы,
+    оплаченный забирает один.
+    """
+    cursor = await db.execute("SELECT COUNT(*), COALESCE(SUM(delta), 0) FROM loyalty_events WHERE order_id = ?", (order['id'],))
+    count, total = await cursor.fetchone()
+    await cursor.close()
+
+    if count:
+        delta = -total
+    elif order['payment_id'] == 'loyalty_program':
+        delta = LEGACY_LOYALTY_REFUND
+    elif order['payment_id'] != 'generated_ticket' and order['amount']:
+        delta = -1
+    else:
+        delta = 0
+    if not delta:
+        return await _apply_loyalty(db, order['user_id'], None, order['id'])
+    return await _record_loyalty(db, order['user_id'], 'revoke', delta, order['id'])
+
+async def verify_loyalty_balances(rebuild: bool = False) -> list[tuple]:
+    """
+    Сверяет материализованные балансы с журналом одним запросом.
+    Возвращает расхождения (user_id, баланс в users, баланс по журналу);
+    с rebuild=True еще и пересчитывает эти балансы по журналу.
+    """
+    query = (
+        "SELECT u.user_id, u.loyalty_visits, COALESCE(l.total, 0) FROM users u "
+        "LEFT JOIN (SELECT user_id, SUM(delta) AS total FROM loyalty_events GROUP BY user_id) l "
+        "ON l.user_id = u.user_id WHERE u.loyalty_visits != COALESCE(l.total, 0)"
+    )
+    if not rebuild:
+        return [tuple(row) for row in await _fetchall(query)]
+
+    async with _transaction() as db:
+        mismatches = [tuple(row) for row in await db.execute_fetchall(query)]
+        await db.executemany(
+            "UPDATE users SET loyalty_visits = ? WHERE user_id = ?",
+            [(ledger, user_id) for user_id, _, ledger in mismatches]
+        )
+    _forget_users(*[user_id for user_id, _, _ in mismatches])
+    return mismatches
+
+async def create_paid_order(user_id, event: dict, amount, payment_id, loyalty_action=None, sheet_writes=None) -> tuple[int, int]:
+    """
+    Оформляет бесплатный билет одной транзакцией: создает заказ сразу со статусом 'paid',
+    меняет счетчик лояльности и ставит в очередь строки для Google Sheets.
+    sheet_writes — функция order_id -> список записей (ID заказа известен только после вставки).
+    Возвращает (order_id, счетчик лояльности после изменения).
+    """
+    async with _transaction() as db:
+        cursor = await db.execute(
+            "INSERT INTO orders (user_id, event_id, event_name, event_datetime, event_price, payment_id, status, amount, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'paid', ?, ?) RETURNING id",
+            (user_id, *_event_snapshot(event), payment_id, amount, datetime.now().isoformat())
+        )
+        order_id = (await cursor.fetchone())[0]
+        await cursor.close()
+        loyalty_count = await _apply_loyalty(db, user_id, loyalty_action, order_id)
+        if sheet_writes:
+            await _insert_sheet_writes(db, sheet_writes(order_id))
+    _forget_users(user_id)
+    return order_id, loyalty_count
+
+async def mark_order_paid(order_id, user_id, payment_id, loyalty_action=None, sheet_writes=()) -> int | None:
+    """
+    Переводит заказ в 'paid' после оплаты и в той же транзакции меняет счетчик лояльности
+    и ставит в очередь строки для Google Sheets.
+    Возвращает счетчик лояльности после изменения или None, если заказ уже был оплачен
+    (например, кнопку "я оплатил" нажали дважды).
+    """
+    async with _transaction() as db:
+        cursor = await db.execute(
+            "UPDATE orders SET status = 'paid', payment_id = ? WHERE id = ? AND status != 'paid' RETURNING id",
+            (payment_id, order_id)
+        )
+        updated = await cursor.fetchone()
+        await cursor.close()
+        if updated is None:
+            return None
+        loyalty_count = await _apply_loyalty(db, user_id, loyalty_action, order_id)
+        await _insert_sheet_writes(db, sheet_writes)
+    _forget_users(user_id)
+    return loyalty_count
+
+async def cancel_order(order_id, sheet_writes=()) -> int | None:
+    """
+    Отменяет оплаченный заказ одной транзакцией: статус 'cancelled', откат баллов лояльности
+    по этому заказу и строки для Google Sheets в очередь.
+    Возвращает новый баланс лояльности или None, если заказ не был оплачен (уже отменен).
+    """
+    async with _transaction() as db:
+        cursor = await db.execute("SELECT * FROM orders WHERE id = ? AND status = 'paid'", (order_id,))
+        order = await cursor.fetchone()
+        await cursor.close()
+        if order is None:
+            return None
         await db.execute(
-            "UPDATE orders SET status = ?, payment_id = ? WHERE id = ?",
-            (status, payment_id, order_id)
+            "UPDATE orders SET status = 'cancelled', payment_id = 'cancelled_by_user' WHERE id = ?", (order_id,)
         )
-        await db.commit()
+        loyalty_count = await _revoke_order_loyalty(db, order)
+        await _insert_sheet_writes(db, sheet_writes)
+    _forget_users(order['user_id'])
+    return loyalty_count
 
 async def get_loyalty_count(user_id: int) -> int:
     """Получает текущее количество накопленных визитов для лояльности."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT loyalty_visits FROM users WHERE user_id = ?", (user_id,))
-        result = await cursor.fetchone()
-        return result[0] if result else 0
-
-async def increment_loyalty_count(user_id: int):
-    """Увеличивает счетчик лояльности на 1."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE users SET loyalty_visits = loyalty_visits + 1 WHERE user_id = ?", (user_id,))
-        await db.commit()
-
-async def reset_loyalty_count(user_id: int):
-    """Сбрасывает счетчик лояльности до 0."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE users SET loyalty_visits = 0 WHERE user_id = ?", (user_id,))
-        await db.commit()
+    user = await get_user_by_id(user_id)
+    return user['loyalty_visits'] if user else 0
 
 async def get_user_paid_orders(user_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT * FROM orders WHERE user_id = ? AND status = 'paid'", (user_id,))
-        return await cursor.fetchall()
+    return await _fetchall("SELECT * FROM orders WHERE user_id = ? AND status = 'paid'", (user_id,))
 
 async def get_order_by_id(order_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT * FROM orders WHERE id = ?", (order_id,))
-        return await cursor.fetchone()
-
-async def decrement_loyalty_count(user_id: int):
-    """Уменьшает счетчик лояльности на 1, но не ниже нуля."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Добавляем проверку, чтобы счетчик не ушел в минус
-        await db.execute(
-            "UPDATE users SET loyalty_visits = loyalty_visits - 1 WHERE user_id = ? AND loyalty_visits > 0",
-            (user_id,)
-        )
-        await db.commit()
+    return await _fetchone("SELECT * FROM orders WHERE id = ?", (order_id,))
 
 async def check_if_ticket_exists(user_id: int, event_id: int) -> bool:
     """
@@ -127,28 +542,230 @@ async def check_if_ticket_exists(user_id: int, event_id: int) -> bool:
     билет на это мероприятие.
     Возвращает True, если билет есть, иначе False.
     """
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Мы ищем хотя бы одну запись, LIMIT 1 делает запрос быстрее
-        cursor = await db.execute(
-            "SELECT 1 FROM orders WHERE user_id = ? AND event_id = ? AND status = 'paid' LIMIT 1",
-            (user_id, event_id)
-        )
-        # Если fetchone() вернет что-то (кортеж), значит запись есть. Если None - записи нет.
-        return await cursor.fetchone() is not None
+    # Мы ищем хотя бы одну запись, LIMIT 1 делает запрос быстрее
+    row = await _fetchone(
+        "SELECT 1 FROM orders WHERE user_id = ? AND event_id = ? AND status = 'paid' LIMIT 1",
+        (user_id, event_id)
+    )
+    # Если вернулась строка (кортеж), значит запись есть. Если None - записи нет.
+    return row is not None
 
-async def set_loyalty_points(user_id: int, points: int):
-    """Устанавливает точное количество баллов лояльности."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE users SET loyalty_visits = ? WHERE user_id = ?", (points, user_id))
-        await db.commit()
+async def adjust_loyalty(user_id: int, delta: int) -> int:
+    """Ручная корректировка баланса (например, администратором). Возвращает новый баланс."""
+    async with _transaction() as db:
+        balance = await _record_loyalty(db, user_id, 'adjust', delta)
+    _forget_users(user_id)
+    return balance
 
 async def update_order_payment_id(order_id: int, payment_id: str):
     """Обновляет payment_id для заказа."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         await db.execute("UPDATE orders SET payment_id = ? WHERE id = ?", (payment_id, order_id))
-        await db.commit()
 
 async def get_user_by_id(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        return await cursor.fetchone()
\ No newline at end of file
+    user = _user_cache.get(user_id, _MISSING)
+    if user is not _MISSING:
+        _user_cache.move_to_end(user_id)
+        _user_cache_stats['hits'] += 1
+        return user
+
+    _user_cache_stats['misses'] += 1
+    generation = _user_cache_generation
+    writing = _write_lock.locked()
+    user = await _fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+    # Во время транзакции строка может устареть сразу после ее коммита
+    if writing or _write_lock.locked() or generation != _user_cache_generation:
+        return user
+    # Несуществующего пользователя тоже запоминаем: add_user выбросит его из кэша
+    _user_cache[user_id] = user
+    if len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+    return user
+
+async def get_order_sheet_rows(order_ids) -> dict:
+    """Возвращает известные номера строк в листе 'Заказы': {order_id: row}."""
+    order_ids = list(order_ids)
+    if not order_ids:
+        return {}
+    placeholders = ', '.join('?' * len(order_ids))
+    rows = await _fetchall(
+        f"SELECT id, sheet_row FROM orders WHERE sheet_row IS NOT NULL AND id IN ({placeholders})",
+        order_ids
+    )
+    return dict(rows)
+
+async def set_order_sheet_rows(rows: dict):
+    """Запоминает номера строк заказов в листе 'Заказы': {order_id: row}."""
+    async with _transaction() as db:
+        await db.executemany("UPDATE orders SET sheet_row = ? WHERE id = ?", [(row, i) for i, row in rows.items()])
+
+# --- Очередь записей в Google Sheets ---
+async def _insert_sheet_writes(db, sheet_writes):
+    """Добавляет записи (worksheet, op, payload) в очередь в рамках открытой транзакции."""
+    now = datetime.now().isoformat()
+    await db.executemany(
+        "INSERT INTO sheets_outbox (worksheet, op, payload, created_at) VALUES (?, ?, ?, ?)",
+        [(worksheet, op, json.dumps(payload, ensure_ascii=False), now) for worksheet, op, payload in sheet_writes]
+    )
+
+async def enqueue_sheet_writes(sheet_writes):
+    """Ставит записи для Google Sheets в очередь отдельной транзакцией."""
+    async with _transaction() as db:
+        await _insert_sheet_writes(db, sheet_writes)
+
+async def get_pending_sheet_writes(limit: int) -> list[tuple]:
+    """Возвращает записи, готовые к отправке: (id, worksheet, op, payload, attempts)."""
+    rows = await _fetchall(
+        "SELECT id, worksheet, op, payload, attempts FROM sheets_outbox "
+        "WHERE next_attempt_at IS NULL OR next_attempt_at <= ? ORDER BY id LIMIT ?",
+        (datetime.now().isoformat(), limit)
+    )
+    return [(row[0], row[1], row[2], json.loads(row[3]), row[4]) for row in rows]
+
+async def get_queued_sheet_append_keys(worksheet: str, keys) -> set:
+    """Какие из ключей (первый столбец строки) еще ждут в очереди записи 'append' в лист worksheet."""
+    keys = list(keys)
+    if not keys:
+        return set()
+    placeholders = ','.join('?' * len(keys))
+    rows = await _fetchall(
+        "SELECT DISTINCT json_extract(payload, '$.row[0]') FROM sheets_outbox "
+        f"WHERE worksheet = ? AND op = 'append' AND json_extract(payload, '$.row[0]') IN ({placeholders})",
+        (worksheet, *keys)
+    )
+    return {row[0] for row in rows}
+
+async def delete_sheet_writes(ids):
+    """Удаляет успешно отправленные записи из очереди."""
+    async with _transaction() as db:
+        await db.executemany("DELETE FROM sheets_outbox WHERE id = ?", [(i,) for i in ids])
+
+async def reschedule_sheet_writes(retries):
+    """Откладывает неотправленные записи. retries — список (id, next_attempt_at, error)."""
+    async with _transaction() as db:
+        await db.executemany(
+            "UPDATE sheets_outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            [(next_attempt_at.isoformat(), error, i) for i, next_attempt_at, error in retries]
+        )
+
+
+# --- Локальная копия листа 'Афиша' ---
+# Таблицу events заполняет синхронизация из services/google_sheets.py. Мероприятия, которые
+# удалили из листа, не стираются (in_sheet = 0): прошедшие мероприятия и заказы на них
+# остаются доступны, в том числе для JOIN с orders.
+def _event_row(event: dict) -> tuple:
+    data = {key: value for key, value in event.items() if key != 'datetime_obj'}
+    return (int(event['ID']), event['ShortName'], event['datetime_obj'].isoformat(), event['Price'],
+            json.dumps(data, ensure_ascii=False))
+
+async def get_sync_state(key: str) -> str | None:
+    row = await _fetchone("SELECT value FROM sync_state WHERE key = ?", (key,))
+    return row[0] if row else None
+
+async def set_sync_state(state: dict):
+    async with _transaction() as db:
+        await db.executemany(
+            "INSERT INTO sync_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            list(state.items())
+        )
+
+async def sync_events(events: list[dict], state: dict):
+    """
+    Заменяет снимок афиши в таблице events и сохраняет метки синхронизации (state)
+    одной транзакцией: строки обновляются на месте, пропавшие из листа помечаются in_sheet = 0.
+    """
+    synced_at = datetime.now().isoformat()
+    async with _transaction() as db:
+        await db.execute("UPDATE events SET in_sheet = 0")
+        await db.executemany(
+            "INSERT INTO events (id, short_name, event_datetime, price, data, in_sheet, synced_at) "
+            "VALUES (?, ?, ?, ?, ?, 1, ?) "
+            "ON CONFLICT(id) DO UPDATE SET short_name = excluded.short_name, event_datetime = excluded.event_datetime, "
+            "price = excluded.price, data = excluded.data, in_sheet = 1, synced_at = excluded.synced_at",
+            [(*_event_row(event), synced_at) for event in events]
+        )
+        await db.executemany(
+            "INSERT INTO sync_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            list(state.items())
+        )
+
+async def get_sheet_events() -> list[dict]:
+    """Мероприятия, которые сейчас есть в листе 'Афиша', в виде строк листа (как get_all_records)."""
+    rows = await _fetchall("SELECT data FROM events WHERE in_sheet = 1 ORDER BY event_datetime")
+    return [json.loads(row[0]) for row in rows]
+
+async def get_paid_orders_for_upcoming_events(user_id: int | None = None, since: datetime | None = None):
+    """
+    Оплаченные заказы на мероприятия, которые еще не прошли (по актуальной дате из афиши),
+    вместе с полями мероприятия. Без user_id — по всем пользователям.
+    since — начиная с какого момента считать мероприятия (по умолчанию — сейчас).
+    """
+    query = (
+        "SELECT o.*, e.short_name AS current_name, e.event_datetime AS current_datetime "
+        "FROM orders o JOIN events e ON e.id = o.event_id "
+        "WHERE o.status = 'paid' AND e.event_datetime > ?"
+    )
+    params = [(since or datetime.now()).isoformat()]
+    if user_id is not None:
+        query += " AND o.user_id = ?"
+        params.append(user_id)
+    return await _fetchall(query + " ORDER BY e.event_datetime", params)
+
+# --- file_id загруженных в Telegram файлов ---
+async def get_media_file_id(path: str, content_hash: str) -> str | None:
+    """file_id файла, если он загружался с тем же содержимым."""
+    row = await _fetchone("SELECT file_id FROM media_cache WHERE path = ? AND content_hash = ?", (path, content_hash))
+    return row[0] if row else None
+
+async def save_media_file_id(path: str, content_hash: str, file_id: str):
+    async with _transaction() as db:
+        await db.execute(
+            "INSERT INTO media_cache (path, content_hash, file_id, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET content_hash = excluded.content_hash, file_id = excluded.file_id, "
+            "updated_at = excluded.updated_at",
+            (path, content_hash, file_id, datetime.now().isoformat())
+        )
+
+async def forget_media_file_id(path: str):
+    async with _transaction() as db:
+        await db.execute("DELETE FROM media_cache WHERE path = ?", (path,))
+
+# --- Доставка напоминаний ---
+# status: 'sent' — доставлено, 'pending' — не удалось, повторим, 'failed' — больше не пытаемся
+REMINDER_MAX_ATTEMPTS = 3
+
+async def get_reminder_recipients(event_id, kind: str):
+    """Оплаченные заказы на мероприятие, которым напоминание kind еще не доставлено и попытки не исчерпаны."""
+    return await _fetchall(
+        "SELECT o.* FROM orders o "
+        "LEFT JOIN reminder_deliveries d ON d.order_id = o.id AND d.kind = ? "
+        "WHERE o.event_id = ? AND o.status = 'paid' AND (d.status IS NULL OR d.status = 'pending') "
+        "ORDER BY o.id",
+        (kind, event_id)
+    )
+
+async def get_reminder_status(order_id: int, kind: str) -> str | None:
+    row = await _fetchone(
+        "SELECT status FROM reminder_deliveries WHERE order_id = ? AND kind = ?", (order_id, kind)
+    )
+    return row[0] if row else None
+
+async def record_reminder_delivery(order_id: int, kind: str, status: str, error: str | None = None) -> str:
+    """
+    Записывает результат попытки доставки. 'pending' после REMINDER_MAX_ATTEMPTS попыток
+    превращается в 'failed'. Возвращает итоговый статус.
+    """
+    async with _transaction() as db:
+        cursor = await db.execute(
+            "INSERT INTO reminder_deliveries (order_id, kind, status, attempts, last_error, updated_at) "
+            "VALUES (?, ?, CASE WHEN ? = 'pending' AND ? <= 1 THEN 'failed' ELSE ? END, 1, ?, ?) "
+            "ON CONFLICT(order_id, kind) DO UPDATE SET "
+            "status = CASE WHEN excluded.status = 'pending' AND attempts + 1 >= ? THEN 'failed' "
+            "ELSE excluded.status END, "
+            "attempts = attempts + 1, last_error = excluded.last_error, updated_at = excluded.updated_at "
+            "RETURNING status",
+            (order_id, kind, status, REMINDER_MAX_ATTEMPTS, status, error, datetime.now().isoformat(),
+             REMINDER_MAX_ATTEMPTS)
+        )
+        row = await cursor.fetchone()
+    return row[0]
\ No newline at end of file
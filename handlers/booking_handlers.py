@@ -1,55 +1,81 @@
 import logging
-import os
 import uuid
-from bot import scheduler
-from datetime import datetime, timedelta
+from datetime import datetime
 from aiogram import Bot, F, Router
 from aiogram.fsm.context import FSMContext
-from aiogram.types import CallbackQuery, FSInputFile, Message
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from aiogram.types import BufferedInputFile, CallbackQuery, Message
 from yookassa import Configuration, Payment
 from config_reader import config
 import database as db
 from keyboards import inline as kb
 from services import google_sheets as gs
-from services.ticket_generator import generate_ticket_image
+from services.ticket_generator import render_ticket, ticket_filename
 from states.user_states import Booking
-from utils.scheduler import request_feedback, send_arrival_info
+from utils.scheduler import schedule_event_jobs, send_arrival_info
 
 router = Router()
 
 Configuration.account_id = config.yookassa_shop_id.get_secret_value()
 Configuration.secret_key = config.yookassa_secret_key.get_secret_value()
 
-async def issue_ticket(callback: CallbackQuery, bot: Bot, order_id: int, event: dict, price: int, promo_code: str | None, original_price: int, payment_id: str):
+async def paid_order_sheet_writes(user, event: dict, price: int, promo_code: str | None):
+    """
+    Возвращает функцию order_id -> строки для листов 'Клиенты' и 'Заказы' по оплаченному заказу.
+    Строки ставятся в очередь в той же транзакции, что и оплата заказа.
+    Строку клиента добавляем, пока его нет в листе 'Клиенты' (дубли отсекает append_unique).
+    """
+    client_write = None
+    if not gs.is_known_client(user.id):
+        user_db_info = await db.get_user_by_id(user.id)
+        full_name = user_db_info[2] if user_db_info else "Гость"
+        phone_number = user_db_info[3] if user_db_info else "Не указан"
+        client_write = gs.client_sheet_write(user_id=user.id, username=user.username,
+                                             full_name=full_name, phone_number=phone_number)
+
+    def build(order_id: int) -> list:
+        order_write = gs.order_sheet_write(order_id=order_id, user_id=user.id, event_name=event['ShortName'],
+                                           event_date=event['DateTime'], amount=price, status='оплачено',
+                                           promo_code=promo_code)
+        return [client_write, order_write] if client_write else [order_write]
+
+    return build
+
+def loyalty_action_for(payment_id: str, price: int) -> str | None:
+    """Как билет меняет счетчик лояльности: подарочный обнуляет, оплаченный деньгами дает +1."""
+    if payment_id == 'loyalty_program':
+        return 'redeem'
+    if price > 0:
+        return 'earn'
+    return None
+
+async def issue_ticket(callback: CallbackQuery, bot: Bot, order_id: int, event: dict, price: int, promo_code: str | None, original_price: int, payment_id: str, loyalty_count: int):
     """
     Общая логика выдачи билета с правильным текстом для всех сценариев.
+    Заказ к этому моменту уже оплачен, а счетчик лояльности изменен (loyalty_count — новое значение).
     """
 
+    # Напоминания рассылаются одной задачей на мероприятие, получателей она берет из SQLite,
+    # поэтому добавляем только недостающие задачи, а не перезаписываем их на каждый билет.
+    # Планируем их до отрисовки: заказ оплачен, даже если билет нарисовать не удастся
+    schedule_event_jobs(int(event['ID']), event['datetime_obj'], replace=False)
+
     user_db_info = await db.get_user_by_id(callback.from_user.id)
     full_name = user_db_info[2] if user_db_info else "Гость"
-    phone_number = user_db_info[3] if user_db_info else "Не указан"
 
     date_str = event['datetime_obj'].strftime('%d.%m.%Y в %H:%M')
-    ticket_path = generate_ticket_image(
+    ticket_image = await render_ticket(
         event_name=event['ShortName'], fio=full_name, date_str=date_str, address="ул. Павла Андреева, д. 23 с. 12"
     )
 
-    if not ticket_path:
+    if not ticket_image:
         await bot.send_message(callback.from_user.id,
                                "упс, не получилось создать твой билетик. пожалуйста, напиши в службу заботы @cotvorenie_space")
         return
 
-    await gs.add_client_to_sheet(user_id=callback.from_user.id, username=callback.from_user.username,
-                                 full_name=full_name, phone_number=phone_number)
-    await gs.add_order_to_sheet(order_id=order_id, user_id=callback.from_user.id, event_name=event['ShortName'],
-                                event_date=event['DateTime'], amount=price, status='оплачено', promo_code=promo_code)
-
     caption_text = ""
 
     # СЦЕНАРИЙ 1: Билет по программе лояльности
     if payment_id == 'loyalty_program':
-        await db.reset_loyalty_count(callback.from_user.id)
         caption_text = (
             f"твой бесплатный билетик на «{event['ShortName']}» готов!\n\n"
             "счетчик лояльности обнулен, начинаем копить снова!\n\n"
@@ -57,11 +83,9 @@ async def issue_ticket(callback: CallbackQuery, bot: Bot, order_id: int, event:
 
     # СЦЕНАРИЙ 2: Билет был ОПЛАЧЕН реальными деньгами (цена > 0)
     elif price > 0:
-        await db.increment_loyalty_count(callback.from_user.id)
-        loyalty_count_after = await db.get_loyalty_count(callback.from_user.id)
         caption_text = (
             f"твой билетик на «{event['ShortName']}» готов!\n\n"
-            f"+1 балл в программе лояльности, теперь у тебя {loyalty_count_after} из 5!\n\n"
+            f"+1 балл в программе лояльности, теперь у тебя {loyalty_count} из 5!\n\n"
         )
 
     # СЦЕНАРИЙ 3: Билет бесплатный (изначально или из-за промокода), но НЕ по лояльности
@@ -70,33 +94,16 @@ async def issue_ticket(callback: CallbackQuery, bot: Bot, order_id: int, event:
 
     caption_text += "возврат возможен не позднее чем за 48 часов до начала мероприятия.\n\nсохрани его и покажи на входе охране. до встречи!"
 
-    photo = FSInputFile(ticket_path)
+    photo = BufferedInputFile(ticket_image, filename=ticket_filename(order_id))
     await bot.send_photo(callback.from_user.id, photo, caption=caption_text, parse_mode="Markdown")
 
-    try:
-        os.remove(ticket_path)
-    except OSError as e:
-        logging.error(f"Ошибка при удалении файла билета {ticket_path}: {e}")
-
     time_until_event = event['datetime_obj'] - datetime.now()
     if time_until_event.total_seconds() < 24 * 3600:
-        await send_arrival_info(bot, callback.from_user.id, callback.from_user.first_name, event, order_id)
+        await send_arrival_info(order_id)
     else:
-        run_date_24h = event['datetime_obj'] - timedelta(hours=24)
-        scheduler.add_job(send_arrival_info, trigger='date', run_date=run_date_24h,
-                          kwargs={'bot': bot, 'user_id': callback.from_user.id,
-                                  'user_name': callback.from_user.first_name, 'event': event, 'order_id': order_id})
         await bot.send_message(callback.from_user.id,
                                "за 24 часа до начала мы вышлем подробную инструкцию, как нас найти. не потеряешься! 😉")
-
-    feedback_date = event['datetime_obj'] + timedelta(hours=18)
-    scheduler.add_job(
-        request_feedback,
-        trigger='date',
-        run_date=feedback_date,
-        kwargs={'bot': bot, 'user_id': callback.from_user.id, 'order_id': order_id}
-    )
-    logging.info(f"Запланирован запрос отзыва для заказа #{order_id} на {feedback_date}")
+    logging.info(f"Заказ #{order_id} добавлен в рассылки напоминаний по мероприятию {event['ID']}")
 
 @router.callback_query(F.data == "events")
 async def show_events_afisha(callback: CallbackQuery):
@@ -105,7 +112,7 @@ async def show_events_afisha(callback: CallbackQuery):
     Каждое мероприятие — это кнопка с коротким названием.
     """
     # Получаем актуальные мероприятия из Google Sheets
-    events = gs.get_events_from_sheet()
+    events = await gs.get_events_from_sheet()
 
     if not events:
         await callback.message.edit_text(
@@ -341,18 +348,23 @@ async def confirm_booking(callback: CallbackQuery, state: FSMContext, bot: Bot):
         # --- НОВАЯ, НАДЕЖНАЯ ЛОГИКА ОПРЕДЕЛЕНИЯ ТИПА ---
         payment_id_for_db = 'loyalty_program' if is_loyalty else 'generated_ticket'
 
-        order_id = await db.create_order(callback.from_user.id, user_data['event_id'], 0)
-        await db.update_order_status(order_id, payment_id_for_db, 'paid')
+        # Заказ, счетчик лояльности и строки для таблицы — одной транзакцией
+        sheet_writes = await paid_order_sheet_writes(callback.from_user, event, 0, promo_code)
+        order_id, loyalty_count = await db.create_paid_order(
+            callback.from_user.id, event, 0, payment_id_for_db,
+            loyalty_action=loyalty_action_for(payment_id_for_db, 0), sheet_writes=sheet_writes
+        )
 
         await issue_ticket(
             callback=callback, bot=bot, order_id=order_id, event=event, price=0,
-            promo_code=promo_code, original_price=original_price, payment_id=payment_id_for_db
+            promo_code=promo_code, original_price=original_price, payment_id=payment_id_for_db,
+            loyalty_count=loyalty_count
         )
         await state.clear()
         return
 
     # СЦЕНАРИЙ 2: Платный билет
-    order_id = await db.create_order(callback.from_user.id, user_data['event_id'], price)
+    order_id = await db.create_order(callback.from_user.id, event, price)
 
     try:
         payment = Payment.create({
@@ -403,12 +415,23 @@ async def check_payment(callback: CallbackQuery, bot: Bot):
             return
 
         await callback.message.edit_text("✔️ оплата прошла успешно! сейчас я пришлю твой билетик...")
-        # Обновляем статус в нашей внутренней БД на 'paid'
-        await db.update_order_status(order_id, payment_id, 'paid')
+        event = await gs.get_order_event(order)
+        price = order['amount']
+        original_price = event['Price']
+        promo_code = payment_info.metadata.get('promo_code')
+
+        # Одной транзакцией: статус 'paid', +1 балл лояльности и строки для таблицы в очередь.
+        # Если заказ уже оплачен параллельным нажатием, повторно билет не выдаем
+        sheet_writes = await paid_order_sheet_writes(callback.from_user, event, price, promo_code)
+        loyalty_count = await db.mark_order_paid(
+            order_id, callback.from_user.id, payment_id,
+            loyalty_action=loyalty_action_for(payment_id, price), sheet_writes=sheet_writes(order_id)
+        )
+        if loyalty_count is None:
+            return
 
         reward_code = None
 
-        promo_code = payment_info.metadata.get('promo_code')
         if promo_code:
             promo_details = await gs.get_promo_details(promo_code)
             if promo_details and promo_details['type'] == 'referral_invite':
@@ -428,12 +451,8 @@ async def check_payment(callback: CallbackQuery, bot: Bot):
             except Exception as e:
                 logging.error(f"Не удалось отправить наградной код пользователю {promo_details['owner_id']}: {e}")
 
-        event = await gs.get_event_by_id_from_sheet(order[2])
-        price = order[5]
-        original_price = event['Price']
-
         # Вызываем нашу общую вспомогательную функцию для выдачи билета
-        await issue_ticket(callback, bot, order_id, event, price, promo_code, original_price, payment_id)
+        await issue_ticket(callback, bot, order_id, event, price, promo_code, original_price, payment_id, loyalty_count)
 
     elif payment_info.status == 'pending':
         await callback.answer("платеж еще не прошел. подожди минутку и попробуй снова 🥹", show_alert=True)
@@ -15,10 +15,10 @@ async def process_rating(callback: CallbackQuery, state: FSMContext):
     rating = int(callback.data.split("_")[1])
     order_id = int(callback.data.split("_")[2])
 
-    # Получаем данные о мероприятии из Google Sheets, чтобы передать их дальше
+    # Название мероприятия берем из снимка в заказе, чтобы передать его дальше
     from database import get_order_by_id
     order = await get_order_by_id(order_id)
-    event = await gs.get_event_by_id_from_sheet(order[2])
+    event = await gs.get_order_event(order)
 
     await state.update_data(rating=rating, event_name=event['ShortName'])
     await state.set_state(Feedback.waiting_for_text)
@@ -5,10 +5,11 @@ import uuid
 from yookassa import Refund
 from aiogram import Bot, F, Router
 from aiogram.filters import CommandStart
-from aiogram.types import CallbackQuery, FSInputFile, Message
+from aiogram.types import CallbackQuery, Message
 import database as db
 from keyboards import inline as kb
 from services import google_sheets as gs
+from services.media_cache import send_media
 from config_reader import config
 from utils import faq_data
 from states.user_states import Checklists
@@ -74,10 +75,9 @@ async def show_loyalty_info(callback: CallbackQuery):
         f"{progress_bar}"
     )
 
-    photo = FSInputFile("loyalty.jpg")
-    await callback.message.answer_photo(
+    await send_media("loyalty.jpg", 'photo', lambda photo: callback.message.answer_photo(
         photo=photo, caption=caption, reply_markup=kb.loyalty_info_keyboard()
-    )
+    ))
     await callback.message.delete()
     await callback.answer()
 
@@ -93,11 +93,13 @@ async def show_my_tickets_list(callback: CallbackQuery):
         )
         return
 
-    orders_with_events = []
-    for order in user_orders:
-        event = await gs.get_event_by_id_from_sheet(order[2])
-        if event:
-            orders_with_events.append((order, event))
+    # Мероприятие берем из снимка в заказе; в афишу идем только за старыми незаполненными заказами
+    orders_with_events = [(order, db.order_event(order)) for order in user_orders]
+    missing = {order['event_id'] for order, event in orders_with_events if event is None}
+    if missing:
+        events = await gs.get_events_by_ids(missing)
+        orders_with_events = [(order, event or events.get(order['event_id'])) for order, event in orders_with_events]
+    orders_with_events = [(order, event) for order, event in orders_with_events if event]
 
     await callback.message.edit_text(
         "вот твои билетики! нажми на любой, чтобы посмотреть детали или отменить запись",
@@ -108,7 +110,7 @@ async def show_my_tickets_list(callback: CallbackQuery):
 async def show_ticket_details(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[2])
     order = await db.get_order_by_id(order_id)
-    event = await gs.get_event_by_id_from_sheet(order[2])
+    event = await gs.get_order_event(order)
 
     event_date_str = event['datetime_obj'].strftime('%d.%m.%Y')
     event_time_str = event['datetime_obj'].strftime('%H:%M')
@@ -130,7 +132,7 @@ async def confirm_cancellation_prompt(callback: CallbackQuery):
     """
     order_id = int(callback.data.split("_")[2])
     order = await db.get_order_by_id(order_id)
-    event = await gs.get_event_by_id_from_sheet(order[2])
+    event = await gs.get_order_event(order)
 
     time_diff = event['datetime_obj'] - datetime.now()
     if time_diff.total_seconds() <= 48 * 3600:
@@ -157,15 +159,15 @@ async def final_cancel_booking(callback: CallbackQuery):
         await callback.message.edit_text("Ошибка: не удалось найти информацию о вашем заказе.")
         return
 
-    event = await gs.get_event_by_id_from_sheet(order[2])
+    event = await gs.get_order_event(order)
     if not event:
         await callback.message.edit_text(
             "Ошибка: не удалось найти информацию о мероприятии. Возможно, оно было удалено.")
         return
 
     # Получаем данные для принятия решения
-    payment_id_from_db = order[3]
-    amount_str = str(order[5])
+    payment_id_from_db = order['payment_id']
+    amount_str = str(order['amount'])
     confirmation_text = ""
     was_cancelled = False  # Флаг, чтобы знать, нужно ли обновлять статусы
 
@@ -196,8 +198,7 @@ async def final_cancel_booking(callback: CallbackQuery):
 
         # СЦЕНАРИЙ 2А: Отменяется "подарочный" билет
         if payment_id_from_db == 'loyalty_program':
-            await db.set_loyalty_points(callback.from_user.id, 5)
-            confirmation_text = f"эх, твой бесплатный билетик отменен. мы вернули тебе 5 баллов лояльности, можешь использовать их на другое мероприятие! ✨"
+            # Текст с числом баллов формируется после отмены, по новому балансу
             was_cancelled = True
 
         # СЦЕНАРИЙ 2Б: Отменяется платный билет
@@ -210,8 +211,7 @@ async def final_cancel_booking(callback: CallbackQuery):
                 }, idempotence_key)
 
                 if refund.status == 'succeeded' or refund.status == 'pending':
-                    await db.decrement_loyalty_count(callback.from_user.id)
-                    confirmation_text = f"эх, твой билетик на '{event['ShortName']}' отменен и деньги скоро вернутся!\n\nодин балл лояльности за этот билет забрали 🥲"
+                    confirmation_text = f"эх, твой билетик на '{event['ShortName']}' отменен и деньги скоро вернутся!"
                     was_cancelled = True
                 else:
                     confirmation_text = f"не удалось оформить возврат (статус ЮKassa: {refund.status}). пожалуйста, обратись в службу заботы @cotvorenie_space"
@@ -222,10 +222,17 @@ async def final_cancel_booking(callback: CallbackQuery):
                 confirmation_text = "какие-то странности при оформлении возврата. обратись, пожалуйста, в службу заботы @cotvorenie_space"
                 was_cancelled = False
 
-    # Обновляем статусы в наших системах, только если отмена прошла успешно
+    # Обновляем статусы в наших системах, только если отмена прошла успешно.
+    # Баллы лояльности по заказу (начисленный или списанные за подарочный билет) откатываются там же
     if was_cancelled:
-        await db.update_order_status(order_id, 'cancelled_by_user', 'cancelled')
-        await gs.update_order_status_in_sheet(order_id, 'возврат')
+        loyalty_count = await db.cancel_order(order_id, sheet_writes=[gs.order_status_sheet_write(order_id, 'возврат')])
+        if loyalty_count is None:
+            confirmation_text = "этот билетик уже отменен"
+        elif payment_id_from_db == 'loyalty_program':
+            confirmation_text = (f"эх, твой бесплатный билетик отменен. мы вернули тебе баллы лояльности — "
+                                 f"теперь у тебя {loyalty_count} из 5, можешь использовать их на другое мероприятие! ✨")
+        elif payment_id_from_db != 'generated_ticket':
+            confirmation_text += f"\n\nбалл лояльности за этот билет забрали, теперь у тебя {loyalty_count} из 5 🥲"
 
     # Отправляем финальное сообщение пользователю
     await callback.message.edit_text(confirmation_text)
@@ -287,10 +294,11 @@ async def send_checklist_file(callback: CallbackQuery, state: FSMContext):
         file_path = os.path.join('checklists', file_name)
 
         if os.path.exists(file_path):
-            document = FSInputFile(file_path)
             button_text = file_name.replace('.pdf', '').replace('_', ' ').capitalize()
             await callback.message.delete()
-            await callback.message.answer_document(document, caption=f"держи чек-лист «{button_text}»!")
+            await send_media(file_path, 'document', lambda document: callback.message.answer_document(
+                document, caption=f"держи чек-лист «{button_text}»!"
+            ))
             await callback.answer()
         else:
             await callback.answer("не могу найти этот чек-лист... возможно, его удалили", show_alert=True)
@@ -1,23 +1,12 @@
+import asyncio
+import hashlib
+import json
+import logging
 import random
 import string
-import gspread
 from datetime import datetime
-from oauth2client.service_account import ServiceAccountCredentials
-
-# Настройки доступа
-SCOPE = [
-    "https://spreadsheets.google.com/feeds",
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-]
-
-# Путь к JSON-ключу
-CREDS_FILE = 'service_account.json'
-creds = ServiceAccountCredentials.from_json_keyfile_name(CREDS_FILE, SCOPE)
-client = gspread.authorize(creds)
-SHEET_NAME = "со-творение"
-spreadsheet = client.open(SHEET_NAME)
+import database as db
+from services import sheets_gateway as gw
 
 # Название листов
 WORKSHEET_AFISHA = "Афиша"
@@ -27,182 +16,430 @@ WORKSHEET_FEEDBACK = "Отзывы"
 WORKSHEET_PROMOCODES = "Промокоды"
 WORKSHEET_REFERRALS = "Рефералы"
 
-# Открываем таблицу
-spreadsheet = client.open(SHEET_NAME)
-worksheet = spreadsheet.worksheet(WORKSHEET_AFISHA)
+# --- Кэш афиши ---
+# Хендлеры читают мероприятия из памяти, а фоновая задача периодически
+# перечитывает лист "Афиша". Если обновление не удалось, продолжаем отдавать
+# последний удачный снимок.
+# Снимок хранится и в SQLite (таблица events): при старте кэш поднимается оттуда, не дожидаясь Google.
+# Лист скачивается, только если таблица менялась (время изменения из Drive), а в SQLite
+# пишется, только если изменилась контрольная сумма строк.
+EVENTS_REFRESH_INTERVAL = 60  # секунд между обновлениями кэша
+LOAD_RETRY_INTERVAL = 10  # секунд между попытками, пока данные ни разу не загрузились
 
-def get_events_from_sheet():
-    """Получает список всех актуальных мероприятий из Google Таблицы."""
-    all_events = worksheet.get_all_records()  # Получаем все записи как список словарей
+_events_cache: list[dict] = []
+_events_by_id: dict[int, dict] = {}
+_events_version = 0
+_events_refreshed_at: datetime | None = None
+_events_refresh_lock = asyncio.Lock()
+
+SYNC_AFISHA_MODIFIED = 'afisha_modified_time'
+SYNC_AFISHA_CHECKSUM = 'afisha_checksum'
+
+
+def _event_key(event_id) -> int | str:
+    """Приводит ID мероприятия к единому виду (в заказах ID хранится числом)."""
+    try:
+        return int(event_id)
+    except (ValueError, TypeError):
+        return event_id
 
-    actual_events = []
-    now = datetime.now()
 
-    for event in all_events:
+def _parse_events(records: list[dict]) -> list[dict]:
+    """Разбирает строки листа "Афиша", добавляя к каждой datetime_obj."""
+    events = []
+    for event in records:
+        if str(event.get('ID', '')).strip() == '':
+            # Без ID мероприятие нельзя ни купить, ни найти по заказу
+            print(f"Пропущена строка афиши без ID: {event.get('ShortName', 'N/A')}")
+            continue
         try:
             # Преобразуем строку с датой в объект datetime
-            event_date = datetime.strptime(event['DateTime'], '%d.%m.%Y %H:%M')
-            # Добавляем в список только те мероприятия, которые еще не прошли
-            if event_date > now:
-                event['datetime_obj'] = event_date  # Сохраняем объект datetime для дальнейшей работы
-                actual_events.append(event)
-        except (ValueError, TypeError):
+            event['datetime_obj'] = datetime.strptime(event['DateTime'], '%d.%m.%Y %H:%M')
+            events.append(event)
+        except (ValueError, TypeError, KeyError):
             # Пропускаем строки с некорректным форматом даты
             print(f"Неверный формат даты для мероприятия ID {event.get('ID', 'N/A')}")
-            continue
+    return events
 
-    return actual_events
 
+def _set_events_cache(events: list[dict]):
+    global _events_cache, _events_by_id, _events_version
+    # Индекс по ID строится один раз на каждую загрузку и включает прошедшие мероприятия
+    _events_cache = events
+    _events_by_id = {_event_key(event['ID']): event for event in events}
+    _events_version += 1
 
-async def get_event_by_id_from_sheet(event_id: int):
-    """Находит одно мероприятие по его ID."""
-    all_events = get_events_from_sheet()
-    for event in all_events:
-        if event['ID'] == event_id:
-            return event
-    return None
 
+def _records_checksum(records: list[dict]) -> str:
+    return hashlib.sha256(json.dumps(records, ensure_ascii=False, sort_keys=True, default=str).encode()).hexdigest()
 
-async def add_client_to_sheet(user_id, username, full_name, phone_number):
-    """Добавляет нового клиента или обновляет данные существующего, НЕ трогая дату регистрации."""
-    try:
-        worksheet = spreadsheet.worksheet(WORKSHEET_CLIENTS)
-
-        # Ищем пользователя по ID в первом столбце
-        # Метод find вернет объект ячейки, если найдет, или None, если не найдет
-        cell = worksheet.find(str(user_id), in_column=1)
-
-        # Если cell is None, значит такого UserID в таблице еще нет
-        if not cell:
-            # ЕСЛИ ПОЛЬЗОВАТЕЛЬ НОВЫЙ
-            # Генерируем дату регистрации и добавляем всю строку
-            registration_date = datetime.now().strftime('%d.%m.%Y %H:%M')
-            row_data = [user_id, username, full_name, phone_number, registration_date]
-            worksheet.append_row(row_data)
-        # Если cell существует, то мы просто ничего не делаем.
-        # Это и есть наша логика: "не обновлять".
 
-    except Exception as e:
-        print(f"Ошибка при записи клиента в Google Sheets: {e}")
+async def load_events_cache_from_db() -> bool:
+    """Поднимает кэш афиши из локальной копии в SQLite. Возвращает True, если копия не пустая."""
+    events = _parse_events(await db.get_sheet_events())
+    if not events:
+        return False
+    _set_events_cache(events)
+    return True
+
+
+async def refresh_events_cache() -> bool:
+    """
+    Синхронизирует кэш и таблицу events с листом "Афиша".
+    Возвращает True при успехе; при ошибке старый снимок остается в силе.
+    """
+    global _events_refreshed_at
+
+    async with _events_refresh_lock:
+        try:
+            modified = await gw.run(None, 'get_lastUpdateTime')
+        except Exception as e:
+            # Без времени изменения просто скачиваем лист целиком
+            print(f"Не удалось узнать время изменения таблицы: {e}")
+            modified = None
+
+        if modified and _events_cache and modified == await db.get_sync_state(SYNC_AFISHA_MODIFIED):
+            _events_refreshed_at = datetime.now()
+            return True
+
+        try:
+            records = await gw.run(WORKSHEET_AFISHA, 'get_all_records')  # Получаем все записи как список словарей
+        except Exception as e:
+            print(f"Ошибка при обновлении кэша афиши: {e}")
+            return False
+
+        # Таблица общая: время изменения меняется и от записей в другие листы,
+        # поэтому сами строки афиши сравниваем по контрольной сумме
+        checksum = _records_checksum(records)
+        state = {SYNC_AFISHA_CHECKSUM: checksum}
+        if modified:
+            state[SYNC_AFISHA_MODIFIED] = modified
+
+        try:
+            if checksum != await db.get_sync_state(SYNC_AFISHA_CHECKSUM):
+                events = _parse_events(records)
+                mirrored = [event for event in events if isinstance(_event_key(event['ID']), int)]
+                await db.sync_events(mirrored, state)
+                _set_events_cache(events)
+            else:
+                await db.set_sync_state(state)
+                if not _events_cache:
+                    _set_events_cache(_parse_events(records))
+        except Exception as e:
+            print(f"Ошибка при сохранении афиши: {e}")
+            return False
+
+        _events_refreshed_at = datetime.now()
+        return True
+
 
-async def add_order_to_sheet(order_id, user_id, event_name, event_date, amount, status, promo_code=None):
-    """Добавляет новый заказ в лист 'Заказы'."""
+def get_events_cache_info() -> dict:
+    """Возвращает версию снимка афиши, время его обновления и размер."""
+    return {'version': _events_version, 'refreshed_at': _events_refreshed_at, 'size': len(_events_cache)}
+
+
+async def run_events_cache_refresher(interval: int = EVENTS_REFRESH_INTERVAL):
+    """Фоновая задача: обновляет кэш афиши каждые interval секунд."""
+    while True:
+        await asyncio.sleep(interval if _events_refreshed_at else LOAD_RETRY_INTERVAL)
+        try:
+            await refresh_events_cache()
+        except Exception as e:
+            logging.error(f"Ошибка при обновлении афиши: {e}")
+
+
+async def get_events_from_sheet():
+    """Получает список всех актуальных мероприятий из кэша афиши."""
+    now = datetime.now()
+    # Фильтруем при каждом чтении: мероприятие могло пройти уже после обновления кэша
+    return [event for event in _events_cache if event['datetime_obj'] > now]
+
+
+async def get_event_by_id_from_sheet(event_id: int, include_past: bool = False):
+    """
+    Находит одно мероприятие по его ID.
+    По умолчанию ищет только среди актуальных мероприятий афиши; с include_past=True
+    находит и прошедшие (нужно для экранов билетов и отзывов).
+    """
+    event = _events_by_id.get(_event_key(event_id))
+    if event is None:
+        return None
+    if not include_past and event['datetime_obj'] <= datetime.now():
+        return None
+    return event
+
+
+async def backfill_order_snapshots():
+    """Копирует поля мероприятий из копии афиши в старые заказы, где снимка еще нет."""
+    updated = await db.backfill_order_event_snapshots()
+    if updated:
+        print(f"Снимок мероприятия заполнен в {updated} заказах")
+
+
+async def get_order_event(order):
+    """
+    Мероприятие заказа: из снимка в самом заказе, а для старых незаполненных
+    заказов — из кэша афиши.
+    """
+    return db.order_event(order) or await get_event_by_id_from_sheet(order['event_id'], include_past=True)
+
+
+async def get_events_by_ids(event_ids) -> dict:
+    """Находит сразу несколько мероприятий (включая прошедшие) за один проход по индексу."""
+    events = {}
+    for event_id in event_ids:
+        event = _events_by_id.get(_event_key(event_id))
+        if event is not None:
+            events[event_id] = event
+    return events
+
+
+# --- Записи в таблицу ---
+# Сами записи не ходят в Google синхронно: функции ниже только формируют строки
+# (worksheet, op, payload) для очереди sheets_outbox, а выгружает их services/sheets_outbox.py.
+
+# Клиенты, которые уже есть в листе 'Клиенты'. Пополняет их очередь после успешной выгрузки
+# (она же ставит флаг users.sheet_synced в SQLite). Пока строка клиента ждет в очереди,
+# повторная покупка поставит ее еще раз — append_unique не допишет дубль.
+_known_clients: set[int] = set()
+
+
+async def reconcile_known_clients() -> bool:
+    """
+    Пересобирает известных клиентов и флаг sheet_synced по листу 'Клиенты'
+    одним чтением первого столбца. Если таблица недоступна, берет их из SQLite.
+    """
     try:
-        worksheet = spreadsheet.worksheet(WORKSHEET_ORDERS)
-        created_at = datetime.now().strftime('%d.%m.%Y %H:%M')
-
-        # --- Убеждаемся, что данные соответствуют 8 столбцам ---
-        # OrderID, UserID, EventName, EventDate, Amount, Status, PromoCode, CreatedAt
-        row_data = [
-            order_id,
-            user_id,
-            event_name,
-            event_date,
-            amount,
-            status,
-            promo_code or '',  # Если промокода нет, вставляем пустую строку
-            created_at
-        ]
-        worksheet.append_row(row_data)
+        values = await gw.run(WORKSHEET_CLIENTS, 'col_values', 1)
     except Exception as e:
-        print(f"Ошибка при записи заказа в Google Sheets: {e}")
+        print(f"Ошибка при сверке листа 'Клиенты': {e}")
+        _known_clients.update(await db.get_sheet_synced_user_ids())
+        return False
 
-async def update_order_status_in_sheet(order_id: int, new_status: str):
-    """Обновляет статус заказа в листе 'Заказы'."""
-    try:
-        worksheet = spreadsheet.worksheet(WORKSHEET_ORDERS)
-        # Находим ячейку с нужным ID заказа (предполагается, что ID в первом столбце)
-        cell = worksheet.find(str(order_id), in_column=1)
+    user_ids = {int(value) for value in values if str(value).strip().isdigit()}
+    await db.reset_users_sheet_synced(user_ids)
+    _known_clients.clear()
+    _known_clients.update(user_ids)
+    return True
 
-        if cell:
-            # Обновляем ячейку в столбце "Статус" (предполагается, что это 6-й столбец, F)
-            worksheet.update_cell(cell.row, 6, new_status)
-    except Exception as e:
-        print(f"Ошибка при обновлении статуса заказа {order_id} в Google Sheets: {e}")
+
+def is_known_client(user_id: int) -> bool:
+    return user_id in _known_clients
+
+
+async def mark_clients_synced(user_ids):
+    """Вызывается очередью, когда строки клиентов точно есть в листе."""
+    user_ids = [int(user_id) for user_id in user_ids]
+    _known_clients.update(user_ids)
+    await db.mark_users_sheet_synced(user_ids)
+
+
+def client_sheet_write(user_id, username, full_name, phone_number) -> tuple:
+    """
+    Строка клиента для листа 'Клиенты'. Существующих клиентов не трогаем, дату регистрации не обновляем.
+    Известным клиент станет, только когда очередь выгрузит строку (mark_clients_synced).
+    """
+    registration_date = datetime.now().strftime('%d.%m.%Y %H:%M')
+    row_data = [user_id, username, full_name, phone_number, registration_date]
+    return WORKSHEET_CLIENTS, 'append_unique', {'row': row_data}
+
+def order_sheet_write(order_id, user_id, event_name, event_date, amount, status, promo_code=None) -> tuple:
+    """Строка нового заказа для листа 'Заказы'."""
+    created_at = datetime.now().strftime('%d.%m.%Y %H:%M')
+
+    # --- Убеждаемся, что данные соответствуют 8 столбцам ---
+    # OrderID, UserID, EventName, EventDate, Amount, Status, PromoCode, CreatedAt
+    row_data = [
+        order_id,
+        user_id,
+        event_name,
+        event_date,
+        amount,
+        status,
+        promo_code or '',  # Если промокода нет, вставляем пустую строку
+        created_at
+    ]
+    return WORKSHEET_ORDERS, 'append', {'row': row_data}
+
+def order_status_sheet_write(order_id: int, new_status: str) -> tuple:
+    """Обновление статуса заказа в листе 'Заказы'."""
+    return WORKSHEET_ORDERS, 'order_status', {'order_id': order_id, 'status': new_status}
 
 async def add_feedback_to_sheet(user_id, event_name, rating, text):
-    """Добавляет отзыв в лист 'Отзывы'."""
-    try:
-        worksheet = spreadsheet.worksheet(WORKSHEET_FEEDBACK)
-        created_at = datetime.now().strftime('%d.%m.%Y %H:%M')
-        row_data = [user_id, event_name, rating, text, created_at]
-        worksheet.append_row(row_data)
-    except Exception as e:
-        print(f"Ошибка при записи отзыва в Google Sheets: {e}")
+    """Ставит отзыв в очередь на запись в лист 'Отзывы'."""
+    created_at = datetime.now().strftime('%d.%m.%Y %H:%M')
+    row_data = [user_id, event_name, rating, text, created_at]
+    await db.enqueue_sheet_writes([(WORKSHEET_FEEDBACK, 'append', {'row': row_data})])
+
+# --- Индекс промокодов и реферальных кодов ---
+# Листы "Промокоды" и "Рефералы" зеркалируются в память, поэтому проверка промокода
+# не ходит в сеть. Индекс периодически перечитывается, а изменения, которые делает
+# сам бот (новый код, активация приглашения), сразу применяются локально.
+PROMO_REFRESH_INTERVAL = 300  # секунд между обновлениями индекса
+
+_promo_codes: dict[str, int] = {}  # стандартный код → скидка в процентах
+_referral_rows: dict[int, dict] = {}  # номер строки листа "Рефералы" → данные строки
+_referral_invites: dict[str, dict] = {}  # FRIEND-код → строка
+_referral_rewards: dict[str, dict] = {}  # REWARD-код → строка
+_promo_index_refreshed_at: datetime | None = None
+_promo_refresh_lock = asyncio.Lock()
+
+
+def _normalize_code(value) -> str:
+    return str(value).strip().upper()
+
+
+def _random_code(prefix: str) -> str:
+    return prefix + ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+
+
+def _index_referral_row(row: dict):
+    _referral_rows[row['row_index']] = row
+    _referral_invites[row['invite_code']] = row
+    if row['reward_code']:
+        _referral_rewards[row['reward_code']] = row
+
+
+async def refresh_promo_index() -> bool:
+    """
+    Перечитывает листы "Промокоды" и "Рефералы" и перестраивает индекс.
+    При ошибке остается прежний индекс.
+    """
+    global _promo_codes, _referral_rows, _referral_invites, _referral_rewards, _promo_index_refreshed_at
+
+    async with _promo_refresh_lock:
+        try:
+            promo_values = await gw.run(WORKSHEET_PROMOCODES, 'get_all_values')
+            referral_values = await gw.run(WORKSHEET_REFERRALS, 'get_all_values')
+        except Exception as e:
+            print(f"Ошибка при обновлении индекса промокодов: {e}")
+            return False
+
+        promo_codes = {}
+        for row in promo_values:
+            try:
+                promo_codes[_normalize_code(row[0])] = int(row[1])
+            except (IndexError, ValueError):
+                continue  # Заголовок или строка без скидки
+
+        old_rows = _referral_rows
+        _referral_rows, _referral_invites, _referral_rewards = {}, {}, {}
+        for row_index, values in enumerate(referral_values, start=1):
+            # InviteCode, OwnerUserID, FriendUserID, FriendOrderID, Status, RewardCode
+            values = values + [''] * (6 - len(values))
+            try:
+                owner_id = int(values[1])
+            except ValueError:
+                continue  # Заголовок или пустая строка
+            row = {
+                'row_index': row_index,
+                'invite_code': _normalize_code(values[0]),
+                'owner_id': owner_id,
+                'status': values[4],
+                'reward_code': _normalize_code(values[5]) if values[5] else '',
+            }
+            # Активация, которая еще ждет выгрузки в очереди, не должна "откатиться"
+            old = old_rows.get(row_index)
+            if old and old['invite_code'] == row['invite_code'] and old['status'] == 'used':
+                row['status'], row['reward_code'] = old['status'], old['reward_code']
+            _index_referral_row(row)
+
+        _promo_codes = promo_codes
+        _promo_index_refreshed_at = datetime.now()
+        return True
+
+
+async def run_promo_index_refresher(interval: int = PROMO_REFRESH_INTERVAL):
+    """Фоновая задача: обновляет индекс промокодов каждые interval секунд."""
+    while True:
+        await asyncio.sleep(interval if _promo_index_refreshed_at else LOAD_RETRY_INTERVAL)
+        try:
+            await refresh_promo_index()
+        except Exception as e:
+            logging.error(f"Ошибка при обновлении индекса промокодов: {e}")
 
-WORKSHEET_PROMOCODES = "Промокоды"
 
 async def get_promo_details(promo_code: str) -> dict | None:
-    """Ищет промокод на правильном листе в зависимости от его префикса."""
-    promo_code = promo_code.strip().upper()
+    """Ищет промокод в локальном индексе в зависимости от его префикса."""
+    promo_code = _normalize_code(promo_code)
 
     # Сценарий 1: Реферальный код для друга
     if promo_code.startswith("FRIEND-"):
-        try:
-            worksheet = spreadsheet.worksheet(WORKSHEET_REFERRALS)
-            cell = worksheet.find(promo_code, in_column=1)
-            if cell:
-                # Проверяем, что статус 'generated' (еще не использован)
-                status = worksheet.cell(cell.row, 5).value
-                if status == 'generated':
-                    owner_id = int(worksheet.cell(cell.row, 2).value)
-                    return {
-                        'type': 'referral_invite',
-                        'discount': 20,
-                        'owner_id': owner_id,
-                        'row_index': cell.row,
-                        'status': status  # <--- Теперь статус всегда будет в словаре
-                    }
-        except Exception as e:
-            print(f"Ошибка при поиске реферального кода {promo_code}: {e}")
+        row = _referral_invites.get(promo_code)
+        # Проверяем, что статус 'generated' (еще не использован)
+        if row and row['status'] == 'generated':
+            return {
+                'type': 'referral_invite',
+                'discount': 20,
+                'owner_id': row['owner_id'],
+                'row_index': row['row_index'],
+                'status': row['status']  # <--- Теперь статус всегда будет в словаре
+            }
         # Если не нашли или статус не 'generated', возвращаем None
         return None
 
     # --- НОВЫЙ СЦЕНАРИЙ 2: Наградной код за друга ---
     elif promo_code.startswith("REWARD-"):
-        try:
-            worksheet = spreadsheet.worksheet(WORKSHEET_REFERRALS)
-            # Ищем наградной код в 6-м столбце
-            cell = worksheet.find(promo_code, in_column=6)
-            if cell:
-                # Проверяем, что основной код уже использован (доп. защита)
-                status = worksheet.cell(cell.row, 5).value
-                if status == 'used':
-                     return {'type': 'referral_reward', 'discount': 20, 'status': 'active'}
-        except Exception as e:
-            print(f"Ошибка при поиске наградного кода {promo_code}: {e}")
+        row = _referral_rewards.get(promo_code)
+        # Проверяем, что основной код уже использован (доп. защита)
+        if row and row['status'] == 'used':
+            return {'type': 'referral_reward', 'discount': 20, 'status': 'active'}
         return None
 
     # СЦЕНАРИЙ 3: Это любой другой (стандартный или наградной) промокод
-    else:
-        try:
-            worksheet = spreadsheet.worksheet(WORKSHEET_PROMOCODES)
-            cell = worksheet.find(promo_code, in_column=1)
-            if cell:
-                discount = int(worksheet.cell(cell.row, 2).value)
-                return {
-                    'type': 'standard',  # или 'referral_reward', если у вас есть такая логика
-                    'discount': discount,
-                    'status': 'active'  # <--- Для стандартных кодов будем считать, что они всегда активны
-                }
-        except Exception as e:
-            print(f"Ошибка при поиске стандартного промокода {promo_code}: {e}")
+    discount = _promo_codes.get(promo_code)
+    if discount is not None:
+        return {
+            'type': 'standard',
+            'discount': discount,
+            'status': 'active'  # <--- Для стандартных кодов будем считать, что они всегда активны
+        }
 
     return None  # Если нигде не нашли
 
 async def generate_and_add_referral_code(user_id: int) -> str | None:
     """Генерирует уникальный реферальный код и добавляет его в лист 'Referrals'."""
     try:
-        worksheet = spreadsheet.worksheet(WORKSHEET_REFERRALS)
-        code = "FRIEND-" + ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-
-        while worksheet.find(code, in_column=1):
-            code = "FRIEND-" + ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+        code = _random_code("FRIEND-")
+        while code in _referral_invites:
+            code = _random_code("FRIEND-")
 
         # InviteCode, OwnerUserID, FriendUserID, FriendOrderID, Status, RewardCode
         row_data = [code, user_id, '', '', 'generated', '']
-        worksheet.append_row(row_data)
-        return code
+        response = await gw.run(WORKSHEET_REFERRALS, 'append_row', row_data)
     except Exception as e:
         print(f"Ошибка при генерации реферального кода для {user_id}: {e}")
-        return None
\ No newline at end of file
+        return None
+
+    appended = gw.appended_rows(response)
+    row_index = appended[0] if appended else None
+    if row_index is not None:
+        _index_referral_row({'row_index': row_index, 'invite_code': code, 'owner_id': user_id,
+                             'status': 'generated', 'reward_code': ''})
+    else:
+        # Номер строки неизвестен — перечитываем лист, чтобы код сразу можно было использовать
+        await refresh_promo_index()
+    return code
+
+async def activate_referral_code(row_index: int, friend_user_id: int, friend_order_id: int) -> str | None:
+    """
+    Отмечает приглашение как использованное и выдает владельцу наградной код.
+    Индекс обновляется сразу, а строка в листе 'Рефералы' — через очередь записей.
+    """
+    row = _referral_rows.get(row_index)
+    if not row or row['status'] != 'generated':
+        return None
+
+    reward_code = _random_code("REWARD-")
+    while reward_code in _referral_rewards:
+        reward_code = _random_code("REWARD-")
+
+    row['status'], row['reward_code'] = 'used', reward_code
+    _referral_rewards[reward_code] = row
+
+    # FriendUserID, FriendOrderID, Status, RewardCode — столбцы C:F
+    await db.enqueue_sheet_writes([(WORKSHEET_REFERRALS, 'update', {
+        'range': f"C{row_index}:F{row_index}",
+        'values': [[friend_user_id, friend_order_id, 'used', reward_code]],
+    })])
+    return reward_code
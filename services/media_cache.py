@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import defaultdict
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+import database as db
+
+# --- Кэш file_id для статичных файлов ---
+# Картинку программы лояльности, чек-листы и видео с маршрутом достаточно загрузить в Telegram
+# один раз: дальше отправляем по file_id, который хранится в SQLite (таблица media_cache).
+# Ключ — путь и хэш содержимого, поэтому измененный файл загрузится заново.
+# Если Telegram не принял сохраненный file_id, файл тоже загружается заново.
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Хэш пересчитывается, только если у файла изменились время изменения или размер
+_hashes: dict[str, tuple[int, int, str]] = {}
+# Одновременные первые отправки одного файла ждут друг друга, а не грузят его дважды
+_upload_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def content_hash(path: str) -> str:
+    stat = os.stat(path)
+    cached = _hashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    file_hash = await asyncio.to_thread(_file_hash, path)
+    _hashes[path] = (stat.st_mtime_ns, stat.st_size, file_hash)
+    return file_hash
+
+
+def _sent_file_id(message: Message, kind: str) -> str | None:
+    if kind == 'photo':
+        return message.photo[-1].file_id if message.photo else None
+    media = getattr(message, kind, None)
+    return media.file_id if media else None
+
+
+async def send_media(path: str, kind: str, send) -> Message:
+    """
+    Отправляет статичный файл по сохраненному file_id, а при его отсутствии загружает файл.
+    kind — 'photo', 'document' или 'video' (поле сообщения, откуда брать file_id);
+    send — функция, которая принимает file_id или FSInputFile и отправляет сообщение, например
+    lambda media: message.answer_photo(photo=media, caption=caption).
+    """
+    file_hash = await content_hash(path)
+
+    file_id = await db.get_media_file_id(path, file_hash)
+    if file_id:
+        try:
+            return await send(file_id)
+        except TelegramBadRequest as e:
+            logging.warning(f"Telegram не принял сохраненный file_id для {path}, загружаем заново: {e}")
+            await db.forget_media_file_id(path)
+
+    async with _upload_locks[path]:
+        # Пока ждали, файл мог загрузить параллельный вызов
+        file_id = await db.get_media_file_id(path, file_hash)
+        if file_id:
+            return await send(file_id)
+
+        # FSInputFile читает файл с диска частями, целиком в память он не попадает
+        message = await send(FSInputFile(path))
+        file_id = _sent_file_id(message, kind)
+        if file_id:
+            await db.save_media_file_id(path, file_hash, file_id)
+        return message
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+import gspread
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from oauth2client.service_account import ServiceAccountCredentials
+from config_reader import config
+
+# Настройки доступа
+SCOPE = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive"
+]
+
+# Путь к JSON-ключу
+CREDS_FILE = 'service_account.json'
+SHEET_NAME = "со-творение"
+
+# Клиент создается лениво, при первом обращении к таблице, а не при импорте:
+# бот запускается и без доступа к Google. Токен обновляет сессия gspread,
+# а после ошибки авторизации клиент и все листы открываются заново.
+_client: gspread.Client | None = None
+_spreadsheet: gspread.Spreadsheet | None = None
+_worksheets: dict[str, gspread.Worksheet] = {}
+_client_lock = threading.Lock()
+
+# gspread синхронный: все его HTTP-вызовы выполняются в ограниченном пуле потоков,
+# чтобы не останавливать цикл событий aiogram. Размер пула задается в .env.
+_executor = ThreadPoolExecutor(max_workers=config.sheets_max_workers, thread_name_prefix="gsheets")
+
+
+def _get_worksheet(worksheet_name: str | None) -> gspread.Worksheet | gspread.Spreadsheet:
+    """
+    Возвращает лист из кэша, при необходимости авторизуясь и открывая таблицу.
+    При worksheet_name=None возвращает саму таблицу.
+    """
+    global _client, _spreadsheet
+
+    worksheet = _worksheets.get(worksheet_name)
+    if worksheet is not None:
+        return worksheet
+
+    with _client_lock:
+        if _spreadsheet is None:
+            creds = ServiceAccountCredentials.from_json_keyfile_name(CREDS_FILE, SCOPE)
+            _client = gspread.authorize(creds)
+            _spreadsheet = _client.open(SHEET_NAME)
+        if worksheet_name is None:
+            return _spreadsheet
+        if worksheet_name not in _worksheets:
+            _worksheets[worksheet_name] = _spreadsheet.worksheet(worksheet_name)
+        return _worksheets[worksheet_name]
+
+
+def _reset_client():
+    """Забывает клиента и листы, чтобы при следующем вызове открыть их заново."""
+    global _client, _spreadsheet
+
+    with _client_lock:
+        _client = None
+        _spreadsheet = None
+        _worksheets.clear()
+
+
+def _is_auth_error(error: Exception) -> bool:
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, 'status_code', None) == 401
+    # Ошибки обновления токена oauth2client / google-auth
+    return type(error).__name__ in ('AccessTokenRefreshError', 'RefreshError')
+
+
+def _invoke(worksheet_name: str, method: str, args: tuple, kwargs: dict):
+    """Выполняется в потоке пула: берет лист и вызывает у него метод gspread."""
+    try:
+        return getattr(_get_worksheet(worksheet_name), method)(*args, **kwargs)
+    except gspread.exceptions.WorksheetNotFound:
+        _worksheets.pop(worksheet_name, None)
+        raise
+    except Exception as e:
+        if not _is_auth_error(e):
+            raise
+    # Авторизация протухла или отозвана — переподключаемся и повторяем вызов один раз
+    _reset_client()
+    return getattr(_get_worksheet(worksheet_name), method)(*args, **kwargs)
+
+
+# --- Лимит запросов и предохранитель ---
+# Квота Sheets API считается в запросах в минуту. Токен-бакет не дает ее превысить,
+# причем фоновые записи оставляют часть квоты (WRITE_RESERVE) под чтения, которых ждут пользователи.
+# Если таблица раз за разом отвечает ошибками, предохранитель размыкается и вызовы
+# сразу получают SheetsUnavailable — вызывающий код в это время работает из кэша.
+WRITE_METHODS = {'append_row', 'append_rows', 'update', 'update_cell', 'batch_update'}
+WRITE_RESERVE = 0.2  # доля квоты, которую записи не трогают
+MAX_RETRIES = 3  # повторов при 429/5xx
+RETRY_BASE_DELAY = 1.0  # секунд, удваивается с каждым повтором
+BREAKER_THRESHOLD = 5  # ошибок подряд, после которых предохранитель размыкается
+BREAKER_COOLDOWN = 60  # секунд до пробного вызова
+
+
+class SheetsUnavailable(Exception):
+    """Предохранитель разомкнут: Google Sheets временно не вызывается."""
+
+
+class _TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60  # токенов в секунду
+        self.tokens = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, write: bool) -> bool:
+        """Забирает токен, при необходимости ожидая. Возвращает True, если пришлось ждать."""
+        needed = 1 + (self.capacity * WRITE_RESERVE if write else 0)
+        waited = False
+        while True:
+            self._refill()
+            if self.tokens >= needed:
+                self.tokens -= 1
+                return waited
+            waited = True
+            await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    def drain(self):
+        """Google уже ответил 429 — притормаживаем всех до восстановления квоты."""
+        self._refill()
+        self.tokens = 0
+
+
+class _CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: int):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'  # closed, open, half_open
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def before_call(self) -> bool:
+        """Пропускает вызов или бросает SheetsUnavailable. Возвращает True для пробного вызова."""
+        if self.state == 'closed':
+            return False
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+            # Пропускаем один пробный вызов, остальные ждут его результата
+            self.state = 'half_open'
+            return True
+        raise SheetsUnavailable(f"Google Sheets недоступен, предохранитель: {self.state}")
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+
+    def release_probe(self):
+        """
+        Пробный вызов завершился, не сообщив, доступен ли Google (ошибка в самом вызове или отмена):
+        размыкаем предохранитель снова, иначе он навсегда остался бы в half_open.
+        """
+        if self.state == 'half_open':
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            if self.state != 'open':
+                _stats['breaker_opened'] += 1
+                logging.warning(f"Предохранитель Google Sheets разомкнут на {self.cooldown} с после {self.failures} ошибок")
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+
+_stats = {
+    'calls': 0,  # вызовов, ушедших в Google
+    'throttled': 0,  # вызовов, которые ждали токен
+    'rate_limited': 0,  # ответов 429 от Google
+    'retries': 0,  # повторных попыток
+    'failures': 0,  # вызовов, завершившихся ошибкой
+    'rejected': 0,  # вызовов, отклоненных разомкнутым предохранителем
+    'breaker_opened': 0,  # сколько раз размыкался предохранитель
+}
+_bucket = _TokenBucket(config.sheets_quota_per_minute)
+_breaker = _CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+
+def _status_code(error: Exception) -> int | None:
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, 'status_code', None)
+    return None
+
+
+def _is_transient(error: Exception) -> bool:
+    """Ошибки, которые говорят о недоступности Google, а не о проблеме в самом запросе."""
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (requests.exceptions.RequestException, OSError))
+
+
+def get_stats() -> dict:
+    """Счетчики обращений к Google Sheets и состояние предохранителя."""
+    return {**_stats, 'breaker_state': _breaker.state, 'tokens': int(_bucket.tokens)}
+
+
+async def run(worksheet_name: str | None, method: str, *args, **kwargs):
+    """
+    Асинхронно вызывает метод gspread у листа worksheet_name, например:
+    await run("Заказы", "append_row", row_data)
+    При worksheet_name=None метод вызывается у самой таблицы: await run(None, "get_lastUpdateTime")
+    Соблюдает квоту API, повторяет вызов при 429 (а чтения — и при 5xx)
+    и бросает SheetsUnavailable, пока предохранитель разомкнут.
+    """
+    loop = asyncio.get_running_loop()
+    write = method in WRITE_METHODS
+
+    attempt = 0
+    while True:
+        try:
+            probe = _breaker.before_call()
+        except SheetsUnavailable:
+            _stats['rejected'] += 1
+            raise
+        if await _bucket.acquire(write):
+            _stats['throttled'] += 1
+
+        _stats['calls'] += 1
+        try:
+            result = await loop.run_in_executor(_executor, partial(_invoke, worksheet_name, method, args, kwargs))
+        except Exception as e:
+            if not _is_transient(e):
+                _stats['failures'] += 1
+                # Ответ gspread (4xx, лист не найден) значит, что Google доступен
+                if isinstance(e, gspread.exceptions.GSpreadException):
+                    _breaker.record_success()
+                raise
+            _breaker.record_failure()
+            status = _status_code(e)
+            if status == 429:
+                _stats['rate_limited'] += 1
+                _bucket.drain()
+            # Запись повторяем только при 429: после 5xx строка могла уже добавиться
+            retryable = status == 429 or not write
+            if attempt >= MAX_RETRIES or not retryable or _breaker.state == 'open':
+                _stats['failures'] += 1
+                raise
+            attempt += 1
+            _stats['retries'] += 1
+            await asyncio.sleep(RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            continue
+        else:
+            _breaker.record_success()
+            return result
+        finally:
+            # Если пробный вызов так и не определил состояние (ошибка в запросе, отмена),
+            # предохранитель снова размыкается, а не остается в half_open
+            if probe:
+                _breaker.release_probe()
+
+
+def appended_rows(response) -> tuple[int, int] | None:
+    """
+    Достает номера первой и последней добавленных строк из ответа append_row/append_rows
+    ('Заказы'!A12:H14 → (12, 14)). Если ответ не распознан, возвращает None.
+    """
+    try:
+        updated_range = response['updates']['updatedRange']
+        rows = [int(row) for row in re.findall(r'[A-Z]+(\d+)', updated_range.split('!')[-1])]
+    except (KeyError, TypeError, AttributeError):
+        return None
+    if not rows:
+        return None
+    return rows[0], rows[-1]
+
+
+def shutdown():
+    """Останавливает пул потоков (вызывается при остановке бота)."""
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+import database as db
+from services import sheets_gateway as gw
+from services import google_sheets as gs
+
+FLUSH_INTERVAL = 5  # секунд между выгрузками очереди
+BATCH_SIZE = 200  # сколько записей забираем из очереди за один проход
+RETRY_BASE_DELAY = 10  # секунд до первой повторной попытки
+RETRY_MAX_DELAY = 15 * 60  # потолок для экспоненциальной задержки
+
+# Порядок обработки операций внутри одного прохода: сначала дописываем строки,
+# потом обновляем статусы, чтобы статус только что добавленного заказа нашел свою строку
+_OP_ORDER = {'append_unique': 0, 'append': 1, 'update': 2, 'order_status': 3}
+
+
+async def _append(worksheet_name: str, payloads: list[dict]):
+    """
+    Дописывает все строки одним вызовом append_rows.
+    Для заказов запоминает в SQLite, в какую строку листа попал каждый заказ.
+    """
+    rows = [payload['row'] for payload in payloads]
+    response = await gw.run(worksheet_name, 'append_rows', rows)
+
+    if worksheet_name == gs.WORKSHEET_ORDERS:
+        appended = gw.appended_rows(response)
+        if appended and appended[1] - appended[0] + 1 == len(rows):
+            await db.set_order_sheet_rows({row[0]: appended[0] + i for i, row in enumerate(rows)})
+
+
+async def _append_unique(worksheet_name: str, payloads: list[dict]):
+    """Дописывает строки, ключа (первый столбец) которых еще нет на листе."""
+    existing = set(await gw.run(worksheet_name, 'col_values', 1))
+    rows = []
+    for payload in payloads:
+        key = str(payload['row'][0])
+        if key not in existing:
+            existing.add(key)
+            rows.append(payload['row'])
+    if rows:
+        await gw.run(worksheet_name, 'append_rows', rows)
+
+    if worksheet_name == gs.WORKSHEET_CLIENTS:
+        await gs.mark_clients_synced(payload['row'][0] for payload in payloads)
+
+
+async def _update(worksheet_name: str, payloads: list[dict]):
+    """Записывает все диапазоны A1 одним batch_update."""
+    await gw.run(worksheet_name, 'batch_update', [{'range': p['range'], 'values': p['values']} for p in payloads])
+
+
+async def _update_order_status(worksheet_name: str, payloads: list[dict]) -> list[dict]:
+    """
+    Обновляет статусы заказов одним batch_update (статус — 6-й столбец, F).
+    Номер строки берется из SQLite; лист сканируется только для заказов,
+    добавленных до того, как бот начал запоминать строки.
+    Возвращает записи, которые нужно повторить позже: строка заказа еще ждет в очереди.
+    """
+    row_by_order = await db.get_order_sheet_rows([payload['order_id'] for payload in payloads])
+    if any(payload['order_id'] not in row_by_order for payload in payloads):
+        order_ids = await gw.run(worksheet_name, 'col_values', 1)
+        scanned = {order_id: row for row, order_id in enumerate(order_ids, start=1)}
+        for payload in payloads:
+            if payload['order_id'] not in row_by_order and str(payload['order_id']) in scanned:
+                row_by_order[payload['order_id']] = scanned[str(payload['order_id'])]
+        await db.set_order_sheet_rows(row_by_order)
+
+    missing = [payload['order_id'] for payload in payloads if payload['order_id'] not in row_by_order]
+    queued = await db.get_queued_sheet_append_keys(worksheet_name, missing)
+
+    data, deferred = [], []
+    for payload in payloads:
+        row = row_by_order.get(payload['order_id'])
+        if row is None:
+            if payload['order_id'] in queued:
+                # Строка заказа еще не дописана (например, ждет повтора после ошибки):
+                # статус откладываем, иначе лист так и останется со старым статусом
+                deferred.append(payload)
+            else:
+                logging.warning(f"Заказ {payload['order_id']} не найден в листе '{worksheet_name}', статус не обновлен")
+            continue
+        data.append({'range': f"F{row}", 'values': [[payload['status']]]})
+    if data:
+        await gw.run(worksheet_name, 'batch_update', data)
+    return deferred
+
+
+_HANDLERS = {
+    'append': _append,
+    'append_unique': _append_unique,
+    'update': _update,
+    'order_status': _update_order_status,
+}
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(RETRY_BASE_DELAY * 2 ** attempts, RETRY_MAX_DELAY))
+
+
+async def flush_sheet_writes() -> int:
+    """
+    Выгружает накопившиеся записи в Google Sheets, объединяя их по листу и операции.
+    Неудавшиеся группы откладываются с экспоненциальной задержкой.
+    Возвращает количество успешно выгруженных записей.
+    """
+    pending = await db.get_pending_sheet_writes(BATCH_SIZE)
+
+    groups: dict[tuple[str, str], list] = {}
+    for entry in pending:
+        _, worksheet_name, op, _, _ = entry
+        groups.setdefault((worksheet_name, op), []).append(entry)
+
+    done, retries = [], []
+    failed_worksheets = set()
+    for (worksheet_name, op), entries in sorted(groups.items(), key=lambda item: _OP_ORDER.get(item[0][1], 99)):
+        error = None
+        if worksheet_name in failed_worksheets:
+            # Не обновляем статусы, если строки этого листа еще не дописаны
+            error = "отложено из-за ошибки предыдущей операции"
+        elif op not in _HANDLERS:
+            error = f"неизвестная операция {op}"
+        else:
+            try:
+                # Обработчик может вернуть часть записей, которые пока рано выгружать
+                deferred = await _HANDLERS[op](worksheet_name, [entry[3] for entry in entries]) or []
+            except Exception as e:
+                error = str(e)
+                logging.error(f"Ошибка выгрузки {len(entries)} записей ({op}) в лист '{worksheet_name}': {e}")
+
+        if error is None:
+            deferred_ids = {id(payload) for payload in deferred}
+            done.extend(entry[0] for entry in entries if id(entry[3]) not in deferred_ids)
+            now = datetime.now()
+            retries.extend((entry[0], now + _retry_delay(entry[4]), "строка еще не выгружена")
+                           for entry in entries if id(entry[3]) in deferred_ids)
+        else:
+            failed_worksheets.add(worksheet_name)
+            now = datetime.now()
+            retries.extend((entry[0], now + _retry_delay(entry[4]), error) for entry in entries)
+
+    if done:
+        await db.delete_sheet_writes(done)
+    if retries:
+        await db.reschedule_sheet_writes(retries)
+    return len(done)
+
+
+async def run_sheet_writes_flusher(interval: int = FLUSH_INTERVAL):
+    """Фоновая задача: периодически выгружает очередь записей в Google Sheets."""
+    while True:
+        try:
+            await flush_sheet_writes()
+        except Exception as e:
+            logging.error(f"Ошибка при выгрузке очереди Google Sheets: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import time
+from aiogram.exceptions import TelegramRetryAfter
+
+# --- Ограничение частоты отправки для рассылок ---
+# Telegram допускает около 30 сообщений в секунду от бота и около одного сообщения в секунду
+# в один чат; при превышении отвечает 429 с retry_after. Рассылки напоминаний идут через
+# send(): он ждет свободного места в общем и в почтовом лимите чата, а на 429 притормаживает
+# все отправки на указанное Telegram время и повторяет запрос.
+GLOBAL_RATE = 25  # сообщений в секунду на всего бота, с запасом от лимита Telegram
+CHAT_INTERVAL = 1.0  # секунд между сообщениями в один чат
+MAX_RETRY_AFTER = 3  # сколько раз повторять запрос после 429, прежде чем вернуть ошибку
+CHAT_SLOTS_LIMIT = 10000  # после стольких чатов в памяти старые записи вычищаются
+
+
+class _RateLimiter:
+    def __init__(self, rate: float, chat_interval: float):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.tokens = float(rate)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.chat_slots: dict[int, float] = {}  # chat_id -> когда в чат можно писать следующий раз
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _reserve_chat_slot(self, chat_id: int) -> float:
+        """Занимает очередное окно для чата и возвращает, сколько до него ждать."""
+        now = time.monotonic()
+        if len(self.chat_slots) > CHAT_SLOTS_LIMIT:
+            self.chat_slots = {chat: slot for chat, slot in self.chat_slots.items() if slot > now}
+        slot = max(now, self.chat_slots.get(chat_id, 0.0))
+        self.chat_slots[chat_id] = slot + self.chat_interval
+        return slot - now
+
+    async def acquire(self, chat_id: int):
+        delay = self._reserve_chat_slot(chat_id)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Общий лимит раздается по очереди, чтобы ожидающие не обгоняли друг друга
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Telegram ответил 429 — останавливаем все отправки на retry_after."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+_limiter = _RateLimiter(GLOBAL_RATE, CHAT_INTERVAL)
+
+
+async def send(chat_id: int, call):
+    """
+    Выполняет отправку в чат chat_id с учетом лимитов Telegram.
+    call — функция без аргументов, которая возвращает корутину запроса, например
+    lambda: bot.send_message(chat_id, text): при 429 запрос создается заново.
+    """
+    for attempt in range(MAX_RETRY_AFTER + 1):
+        await _limiter.acquire(chat_id)
+        try:
+            return await call()
+        except TelegramRetryAfter as e:
+            if attempt == MAX_RETRY_AFTER:
+                raise
+            logging.warning(f"Telegram ограничил частоту отправки, пауза {e.retry_after} с (чат {chat_id})")
+            _limiter.pause(e.retry_after)
\ No newline at end of file
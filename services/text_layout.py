@@ -0,0 +1,68 @@
+from functools import lru_cache
+from PIL import ImageFont
+
+# Допуск на кернинг между словами: ширина строки считается суммой ширин слов,
+# и если сумма оказалась ближе к границе, чем KERNING_SLACK пикселей на слово,
+# строку перемеряем целиком
+KERNING_SLACK = 2
+
+
+@lru_cache(maxsize=8192)
+def text_length(font: ImageFont.FreeTypeFont, text: str) -> float:
+    """Ширина продвижения строки (куда встанет следующий символ). Кэшируется по шрифту и строке."""
+    return font.getlength(text)
+
+
+@lru_cache(maxsize=8192)
+def text_bbox(font: ImageFont.FreeTypeFont, text: str) -> tuple[int, int, int, int]:
+    """Габариты строки от точки начала, как font.getbbox. Кэшируется по шрифту и строке."""
+    return font.getbbox(text)
+
+
+def _fits(font: ImageFont.FreeTypeFont, prefix: list[str], prefix_length: float, word: str, max_width: int) -> bool:
+    """
+    Помещается ли строка "prefix word" в max_width, по тому же правилу, что и раньше:
+    правый край габарита строки не дальше max_width.
+    """
+    estimate = prefix_length + text_bbox(font, word)[2]
+    if abs(estimate - max_width) > KERNING_SLACK * (len(prefix) + 1):
+        return estimate <= max_width
+    return text_bbox(font, ''.join(prefix) + word)[2] <= max_width
+
+
+def wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: int) -> list[str]:
+    """
+    Переносит текст по словам, жадно заполняя строки. Каждое слово измеряется один раз,
+    ширина строки складывается из ширин слов, поэтому время линейно по длине текста.
+    Слово, которое не влезает даже одно, остается на отдельной строке.
+    """
+    if text_bbox(font, text)[2] <= max_width:
+        return [text]
+
+    lines = []
+    prefix: list[str] = []  # слова текущей строки, каждое с пробелом на конце
+    prefix_length = 0.0
+    for word in text.split(' '):
+        if prefix and not _fits(font, prefix, prefix_length, word, max_width):
+            lines.append(''.join(prefix).strip())
+            prefix, prefix_length = [], 0.0
+        prefix.append(word + ' ')
+        prefix_length += text_length(font, word + ' ')
+    if prefix:
+        lines.append(''.join(prefix).strip())
+    return lines
+
+
+def layout_text_block(text: str, font: ImageFont.FreeTypeFont, x_pos: int, y_start: int, max_width: int,
+                      line_spacing: int) -> tuple[list[tuple[str, tuple[int, int]]], int]:
+    """
+    Раскладывает текстовый блок с автопереносом.
+    Возвращает строки с координатами для draw.text и Y-координату ПОСЛЕ блока.
+    """
+    boxes = []
+    current_y = y_start
+    for line in wrap_text(text, font, max_width):
+        boxes.append((line, (x_pos, current_y)))
+        # Смещаемся вниз на высоту строки + межстрочный интервал
+        current_y += text_bbox(font, line)[3] + line_spacing
+    return boxes, current_y
@@ -1,102 +1,213 @@
+import asyncio
+import io
+import logging
+import multiprocessing
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image, ImageDraw, ImageFont
+from services.text_layout import layout_text_block
 
-def wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: int):
-    """
-    Вспомогательная функция для переноса текста на новую строку.
-    (Эта функция остается без изменений).
-    """
-    lines = []
-    if font.getbbox(text)[2] <= max_width:
-        lines.append(text)
-    else:
-        words = text.split(' ')
-        i = 0
-        while i < len(words):
-            line = ''
-            while i < len(words) and font.getbbox(line + words[i])[2] <= max_width:
-                line = line + words[i] + " "
-                i += 1
-            if not line:
-                line = words[i]
-                i += 1
-            lines.append(line.strip())
-    return lines
-
-def draw_text_block(draw, text, x_pos, y_start, font, max_width, line_spacing):
+# Шаблон и шрифты
+TEMPLATE_PATH = "ticket_template.jpg"
+BOLD_FONT_PATH = "Montserrat-Bold.ttf"
+REGULAR_FONT_PATH = "Montserrat-Regular.ttf"
+EVENT_FONT_SIZE = 100
+DETAILS_FONT_SIZE = 90
+
+# Отступы и позиционирование
+START_X = 280  # Горизонтальный отступ слева
+START_Y = 180  # Вертикальный отступ для самого первого элемента
+MAX_TEXT_WIDTH = 1500  # Максимальная ширина текстового блока
+
+# Промежутки между элементами
+LINE_SPACING = 0  # Расстояние между строками ВНУТРИ одного блока (название, фио)
+BLOCK_SPACING = 100  # Расстояние МЕЖДУ блоками (между названием и ФИО, между ФИО и датой)
+
+# Формат готового билета. Шаблон — фотография, поэтому JPEG/WebP в разы легче PNG
+# и кодируются быстрее; Telegram все равно пережимает фото до ~1280-2560 px по длинной стороне.
+# В боте значения задаются в .env (см. config_reader.py) и передаются в configure_output()
+OUTPUT_FORMATS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+OUTPUT_FORMAT = 'JPEG'
+OUTPUT_QUALITY = 85  # для JPEG и WebP
+OUTPUT_MAX_SIZE = 1200  # максимальная длинная сторона в пикселях, 0 — без уменьшения
+
+# Сколько памяти (в байтах, на каждый процесс отрисовки) отводится под готовые слои билетов.
+# Подложка с названием мероприятия весит как весь шаблон (~10 МБ), так что это ~6 мероприятий
+RENDER_CACHE_BYTES = 64 * 1024 * 1024
+
+def draw_text_block(draw, text, x_pos, y_start, font, max_width, line_spacing, fill="black"):
     """
     Рисует текстовый блок с автопереносом и возвращает новую Y-координату
-    (положение курсора ПОСЛЕ этого блока).
+    (положение курсора ПОСЛЕ этого блока). Раскладку строк считает services/text_layout.py.
     """
-    lines = wrap_text(text, font, max_width)
-    current_y = y_start
-    for line in lines:
-        draw.text((x_pos, current_y), line, font=font, fill="black")
-        # Смещаемся вниз на высоту строки + межстрочный интервал
-        current_y += font.getbbox(line)[3] + line_spacing
-    return current_y
+    lines, end_y = layout_text_block(text, font, x_pos, y_start, max_width, line_spacing)
+    for line, position in lines:
+        draw.text(position, line, font=font, fill=fill)
+    return end_y
+
+
+class _LayerCache:
+    """LRU-кэш готовых слоев с ограничением по занимаемой памяти."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value, size: int):
+        self._items[key] = (value, size)
+        self.bytes += size
+        # Самый свежий слой остается, даже если сам по себе не влезает в лимит
+        while self.bytes > self.max_bytes and len(self._items) > 1:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def info(self) -> dict:
+        return {'entries': len(self._items), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+# Запас слева у маски хвоста: некоторые глифы выступают левее точки начала строки
+TAIL_MARGIN = 20
+
 
+def _image_bytes(img: Image.Image) -> int:
+    return img.width * img.height * len(img.getbands())
 
-def generate_ticket_image(event_name: str, fio: str, date_str: str, address: str) -> str:
+
+class TicketRenderer:
     """
-    Генерирует изображение билета с ДИНАМИЧЕСКИМ позиционированием текста.
+    Рисует билеты на заранее загруженном шаблоне.
+    Шаблон декодируется и шрифты разбираются один раз при создании объекта.
+    Билет собирается из готовых слоев: подложка (шаблон + название мероприятия) кэшируется
+    по мероприятию, хвост (дата и адрес) — маской по паре дата/адрес. На каждый билет
+    остается скопировать подложку, написать ФИО и наложить хвост.
     """
-    try:
-        template_path = "ticket_template.jpg"
-        img = Image.open(template_path)
-        draw = ImageDraw.Draw(img)
-
-        # --- НАСТРОЙКИ ВНЕШНЕГО ВИДА ---
-        # Шрифты
-        bold_font_path = "Montserrat-Bold.ttf"
-        regular_font_path = "Montserrat-Regular.ttf"
-        font_event = ImageFont.truetype(bold_font_path, size=100)
-        font_details = ImageFont.truetype(regular_font_path, size=90)
-
-        # Отступы и позиционирование
-        START_X = 280  # Горизонтальный отступ слева
-        START_Y = 180  # Вертикальный отступ для самого первого элемента
-        MAX_TEXT_WIDTH = 1500  # Максимальная ширина текстового блока
-
-        # Промежутки между элементами
-        LINE_SPACING = 0  # Расстояние между строками ВНУТРИ одного блока (название, фио)
-        BLOCK_SPACING = 100  # Расстояние МЕЖДУ блоками (между названием и ФИО, между ФИО и датой)
-
-        # --- ПРОЦЕСС РИСОВАНИЯ ---
-        # Инициализируем наш "Y-курсор"
-        current_y = START_Y
-
-        # 1. Рисуем НАЗВАНИЕ МЕРОПРИЯТИЯ
-        # Функция вернет новую позицию курсора после отрисовки всего блока
-        new_y_after_event = draw_text_block(
-            draw, event_name, START_X, current_y, font_event, MAX_TEXT_WIDTH, LINE_SPACING
-        )
-        current_y = new_y_after_event
+
+    def __init__(self, template_path: str = TEMPLATE_PATH, bold_font_path: str = BOLD_FONT_PATH,
+                 regular_font_path: str = REGULAR_FONT_PATH, cache_bytes: int = RENDER_CACHE_BYTES):
+        with Image.open(template_path) as template:
+            template.load()
+            self.template = template.copy()
+        self.font_event = ImageFont.truetype(bold_font_path, size=EVENT_FONT_SIZE)
+        self.font_details = ImageFont.truetype(regular_font_path, size=DETAILS_FONT_SIZE)
+        self.cache = _LayerCache(cache_bytes)
+
+    def _base_layer(self, event_name: str) -> tuple[Image.Image, int]:
+        """Шаблон с названием мероприятия и Y-координата после названия."""
+        key = ('base', event_name)
+        layer = self.cache.get(key)
+        if layer is None:
+            img = self.template.copy()
+            end_y = draw_text_block(
+                ImageDraw.Draw(img), event_name, START_X, START_Y, self.font_event, MAX_TEXT_WIDTH, LINE_SPACING
+            )
+            layer = (img, end_y)
+            self.cache.put(key, layer, _image_bytes(img))
+        return layer
+
+    def _tail_mask(self, date_str: str, address: str) -> Image.Image:
+        """Маска с датой и адресом (255 — текст), которую накладываем черным под ФИО."""
+        key = ('tail', date_str, address)
+        mask = self.cache.get(key)
+        if mask is None:
+            mask = Image.new('L', (self.template.width - START_X + TAIL_MARGIN, self.template.height))
+            draw = ImageDraw.Draw(mask)
+            current_y = draw_text_block(
+                draw, date_str, TAIL_MARGIN, 0, self.font_details, MAX_TEXT_WIDTH, LINE_SPACING, fill=255
+            )
+            current_y += BLOCK_SPACING
+            end_y = draw_text_block(
+                draw, address, TAIL_MARGIN, current_y, self.font_details, MAX_TEXT_WIDTH, LINE_SPACING, fill=255
+            )
+            bbox = mask.getbbox()
+            mask = mask.crop((0, 0, mask.width, max(end_y, bbox[3] if bbox else 0, 1)))
+            self.cache.put(key, mask, _image_bytes(mask))
+        return mask
+
+    def render(self, event_name: str, fio: str, date_str: str, address: str) -> Image.Image:
+        """Рисует билет с ДИНАМИЧЕСКИМ позиционированием текста и возвращает картинку."""
+        # 1. Подложка с НАЗВАНИЕМ МЕРОПРИЯТИЯ и положение "Y-курсора" после него
+        base, current_y = self._base_layer(event_name)
+        img = base.copy()
 
         # 2. Добавляем отступ и рисуем ФИО
         current_y += BLOCK_SPACING  # Добавляем большой отступ между блоками
-        new_y_after_fio = draw_text_block(
-            draw, fio, START_X, current_y, font_details, MAX_TEXT_WIDTH, LINE_SPACING
+        current_y = draw_text_block(
+            ImageDraw.Draw(img), fio, START_X, current_y, self.font_details, MAX_TEXT_WIDTH, LINE_SPACING
         )
-        current_y = new_y_after_fio
 
-        # 3. Добавляем отступ и рисуем ДАТУ
+        # 3-4. Добавляем отступ и накладываем ДАТУ и АДРЕС
         current_y += BLOCK_SPACING
-        new_y_after_date = draw_text_block(
-            draw, date_str, START_X, current_y, font_details, MAX_TEXT_WIDTH, LINE_SPACING
-        )
-        current_y = new_y_after_date
+        img.paste("black", (START_X - TAIL_MARGIN, current_y), self._tail_mask(date_str, address))
+        return img
 
-        # 4. Добавляем отступ и рисуем АДРЕС
-        current_y += BLOCK_SPACING
-        draw_text_block(
-            draw, address, START_X, current_y, font_details, MAX_TEXT_WIDTH, LINE_SPACING
-        )
+    def cache_info(self) -> dict:
+        """Сколько слоев в кэше, сколько памяти они занимают, попадания и промахи."""
+        return self.cache.info()
+
+
+def encode_ticket(img: Image.Image, output_format: str, quality: int, max_size: int) -> bytes:
+    """
+    Уменьшает картинку в целое число раз, чтобы длинная сторона была не больше max_size,
+    и кодирует в нужный формат.
+    """
+    longest = max(img.size)
+    if max_size and longest > max_size:
+        # Усреднение блоков пикселей (reduce) в разы дешевле LANCZOS: с ним уменьшение и
+        # кодирование вместе быстрее, чем кодирование полного размера
+        img = img.reduce(-(-longest // max_size))
+    buffer = io.BytesIO()
+    if output_format == 'PNG':
+        img.save(buffer, format='PNG')
+    else:
+        img.save(buffer, format=output_format, quality=quality)
+    return buffer.getvalue()
+
+
+def configure_output(output_format: str = OUTPUT_FORMAT, quality: int = OUTPUT_QUALITY, max_size: int = OUTPUT_MAX_SIZE):
+    """Задает формат, качество и размер билетов в текущем процессе."""
+    global OUTPUT_FORMAT, OUTPUT_QUALITY, OUTPUT_MAX_SIZE
+    output_format = output_format.upper()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Неподдерживаемый формат билета: {output_format}")
+    OUTPUT_FORMAT, OUTPUT_QUALITY, OUTPUT_MAX_SIZE = output_format, quality, max_size
 
-        # Сохраняем результат
-        output_path = f"generated_tickets/ticket_{fio.replace(' ', '_')}.png"
-        img.save(output_path)
-        return output_path
+
+def ticket_filename(order_id: int) -> str:
+    return f"ticket_{order_id}.{OUTPUT_FORMATS[OUTPUT_FORMAT]}"
+
+
+_renderer: TicketRenderer | None = None
+
+
+def get_renderer() -> TicketRenderer:
+    """Возвращает общий рендерер, загружая шаблон и шрифты при первом обращении."""
+    global _renderer
+    if _renderer is None:
+        _renderer = TicketRenderer()
+    return _renderer
+
+
+def generate_ticket_image(event_name: str, fio: str, date_str: str, address: str) -> bytes | None:
+    """
+    Генерирует изображение билета и возвращает его байты в формате OUTPUT_FORMAT (без записи на диск).
+    """
+    try:
+        img = get_renderer().render(event_name, fio, date_str, address)
+        return encode_ticket(img, OUTPUT_FORMAT, OUTPUT_QUALITY, OUTPUT_MAX_SIZE)
 
     except FileNotFoundError as e:
         print(f"Ошибка: Не найден файл шаблона или шрифта! Проверьте: {e}")
@@ -106,7 +217,91 @@ def generate_ticket_image(event_name: str, fio: str, date_str: str, address: str
         return None
 
 
-import os
+# --- Пул процессов для отрисовки ---
+# Pillow держит GIL, поэтому билеты рисуются в отдельных процессах, а не в цикле событий aiogram.
+# Каждый процесс при старте загружает свой TicketRenderer. Одновременно в пуле не больше
+# RENDER_QUEUE_PER_WORKER задач на процесс: остальные вызовы ждут свободного места,
+# а если не дождались за RENDER_WAIT_TIMEOUT секунд — получают None, как при ошибке отрисовки.
+# Если процесс пула упал, пул пересоздается, а билет, на котором это случилось, рисуется в потоке.
+RENDER_QUEUE_PER_WORKER = 2
+RENDER_WAIT_TIMEOUT = 30
+
+_pool: ProcessPoolExecutor | None = None
+_pool_workers = 0
+_pool_lock = asyncio.Lock()
+_render_slots: asyncio.Semaphore | None = None
+
+
+def _init_worker(output_format: str, quality: int, max_size: int):
+    configure_output(output_format, quality, max_size)
+    get_renderer()
+
+
+def _warm_up() -> int:
+    return os.getpid()
+
 
-if not os.path.exists('generated_tickets'):
-    os.makedirs('generated_tickets')
\ No newline at end of file
+def _create_pool(workers: int) -> ProcessPoolExecutor:
+    # forkserver/spawn: не копируем в процессы потоки и соединения основного процесса
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                               initargs=(OUTPUT_FORMAT, OUTPUT_QUALITY, OUTPUT_MAX_SIZE))
+
+
+async def start_render_pool(workers: int = 0):
+    """Запускает пул (workers=0 — по числу ядер) и дожидается, пока процессы загрузят шаблон и шрифты."""
+    global _pool, _pool_workers, _render_slots
+    workers = workers or os.cpu_count() or 1
+    _pool_workers = workers
+    _pool = _create_pool(workers)
+    _render_slots = asyncio.Semaphore(workers * RENDER_QUEUE_PER_WORKER)
+
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[loop.run_in_executor(_pool, _warm_up) for _ in range(workers)])
+
+
+async def _restart_broken_pool(broken: ProcessPoolExecutor):
+    """Заменяет сломанный пул новым; параллельные вызовы с тем же пулом пересоздают его один раз."""
+    global _pool
+    async with _pool_lock:
+        if _pool is not broken:
+            return
+        logging.error("Процесс отрисовки билетов завершился аварийно, пул перезапускается")
+        broken.shutdown(wait=False, cancel_futures=True)
+        _pool = _create_pool(_pool_workers)
+
+
+def shutdown_render_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def render_ticket(event_name: str, fio: str, date_str: str, address: str) -> bytes | None:
+    """
+    Асинхронная обертка над generate_ticket_image: рисует билет в пуле процессов
+    (или в потоке, если пул не запущен) и возвращает байты картинки либо None.
+    """
+    loop = asyncio.get_running_loop()
+    if _pool is None:
+        return await loop.run_in_executor(None, generate_ticket_image, event_name, fio, date_str, address)
+
+    try:
+        await asyncio.wait_for(_render_slots.acquire(), timeout=RENDER_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning("Пул отрисовки билетов перегружен, билет не сгенерирован")
+        return None
+    pool = _pool
+    try:
+        return await loop.run_in_executor(pool, generate_ticket_image, event_name, fio, date_str, address)
+    except BrokenProcessPool:
+        # Процесс пула упал (нехватка памяти, сбой FreeType) и пул больше не принимает задачи
+        await _restart_broken_pool(pool)
+        return await loop.run_in_executor(None, generate_ticket_image, event_name, fio, date_str, address)
+    except Exception as e:
+        logging.error(f"Ошибка в процессе отрисовки билета: {e}")
+        return None
+    finally:
+        _render_slots.release()
\ No newline at end of file
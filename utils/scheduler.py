@@ -1,21 +1,216 @@
+import asyncio
+import logging
 import os
+from datetime import datetime, timedelta
 from aiogram import Bot
-from aiogram.types import InputFile
-from aiogram.types import BufferedInputFile
+from aiogram.exceptions import TelegramForbiddenError
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+import database as db
+from services import google_sheets as gs
+from services import telegram_sender as tg
+from services.media_cache import send_media
 
-async def send_arrival_info(bot: Bot, user_id: int, user_name: str, event: dict, order_id: int = None):
-    """Отправляет инструкцию, как добраться до места."""
-    if order_id:
-        from database import get_order_by_id
-        order = await get_order_by_id(order_id)
-        if not order or order[4] != 'paid':
-            return
+# --- Планировщик напоминаний ---
+# Задачи хранятся в отдельном файле SQLite (JOBS_DB_NAME) и переживают перезапуск.
+# Хранилище APScheduler пишет синхронно из цикла событий: в общей с ботом базе его запись
+# ждала бы блокировку открытой транзакции aiosqlite, а та не может закоммититься, пока цикл стоит.
+# На мероприятие заводится по одной задаче на каждый вид напоминания: в момент запуска она
+# берет из SQLite оплаченные заказы, которым напоминание еще не доставлено, и рассылает их
+# с учетом лимитов Telegram (services/telegram_sender.py). Результат по каждому заказу
+# пишется в reminder_deliveries, поэтому повторный запуск продолжает с неотправленных.
+ARRIVAL_INFO_BEFORE = timedelta(hours=24)  # инструкция, как добраться, — за сутки до начала
+FEEDBACK_AFTER = timedelta(hours=18)  # просьба оставить отзыв — на следующий день
+FEEDBACK_RESUME_WINDOW = timedelta(hours=6)  # сколько еще можно дослать запрос отзыва
+MISFIRE_GRACE_TIME = 3600  # секунд: пропущенное за время перезапуска напоминание еще отправится
+JOBS_DB_NAME = 'scheduler_jobs.db'
+FANOUT_CONCURRENCY = 20  # сколько получателей обрабатывается одновременно
+RETRY_DELAY = timedelta(minutes=10)  # через сколько повторить рассылку для недоставленных
+
+# Вид напоминания -> (когда отправлять, до какого момента еще досылать), относительно начала мероприятия
+REMINDERS = {
+    'arrival': (-ARRIVAL_INFO_BEFORE, timedelta(0)),
+    'feedback': (FEEDBACK_AFTER, FEEDBACK_AFTER + FEEDBACK_RESUME_WINDOW),
+}
+
+scheduler = AsyncIOScheduler(
+    timezone="Europe/Moscow",
+    job_defaults={'misfire_grace_time': MISFIRE_GRACE_TIME, 'coalesce': True},
+)
+_bot: Bot | None = None
+_running_fanouts: set[tuple] = set()  # (event_id, kind) рассылок, которые идут прямо сейчас
+
+
+def setup_scheduler(bot: Bot, db_path: str = JOBS_DB_NAME):
+    """Запоминает бота для задач и подключает хранилище задач в SQLite (до scheduler.start())."""
+    global _bot
+    _bot = bot
+    scheduler.add_jobstore(SQLAlchemyJobStore(url=f"sqlite:///{db_path}"), 'default')
+
+
+def _job_id(event_id, kind: str) -> str:
+    return f"{kind}_event_{event_id}"
+
+
+def schedule_event_jobs(event_id, event_datetime: datetime, replace: bool = True) -> int:
+    """
+    Планирует рассылку инструкции за сутки до мероприятия и запроса отзыва после него.
+    ID задач зависят только от мероприятия, поэтому повторный вызов не создает дублей.
+    С replace=False уже запланированные задачи не трогаются. Возвращает число добавленных задач.
+    """
+    now = datetime.now()
+    added = 0
+    for kind, (offset, _) in REMINDERS.items():
+        job_id = _job_id(event_id, kind)
+        run_date = event_datetime + offset
+        if run_date <= now or (not replace and scheduler.get_job(job_id)):
+            continue
+        scheduler.add_job(send_event_reminders, trigger='date', run_date=run_date, id=job_id,
+                          kwargs={'event_id': event_id, 'kind': kind}, replace_existing=True)
+        added += 1
+    return added
+
+
+def _job_will_run(job_id: str, now: datetime) -> bool:
+    """Есть ли задача в хранилище и не пропущена ли она окончательно (такую планировщик просто удалит)."""
+    job = scheduler.get_job(job_id)
+    if job is None or job.next_run_time is None:
+        return False
+    return job.next_run_time.replace(tzinfo=None) + timedelta(seconds=MISFIRE_GRACE_TIME) > now
+
+
+def _schedule_retry(event_id, kind: str, delay: timedelta):
+    scheduler.add_job(send_event_reminders, trigger='date', run_date=datetime.now() + delay,
+                      id=f"{_job_id(event_id, kind)}_retry",
+                      kwargs={'event_id': event_id, 'kind': kind}, replace_existing=True)
+
+
+async def rebuild_jobs() -> int:
+    """
+    Восстанавливает задачи, которых нет в хранилище, по мероприятиям с оплаченными заказами.
+    Если время напоминания прошло, пока бот не работал, но отправлять его еще не поздно,
+    запускает рассылку сразу: она дошлет только недоставленное.
+    Возвращает число добавленных задач.
+    """
+    now = datetime.now()
+    longest_window = max(deadline for _, deadline in REMINDERS.values())
+    events = {}
+    for order in await db.get_paid_orders_for_upcoming_events(since=now - longest_window):
+        events[order['event_id']] = datetime.fromisoformat(order['current_datetime'])
+
+    added = 0
+    for event_id, event_datetime in events.items():
+        added += schedule_event_jobs(event_id, event_datetime, replace=False)
+        for kind, (offset, deadline) in REMINDERS.items():
+            if not (event_datetime + offset <= now < event_datetime + deadline):
+                continue
+            # Задача еще успеет выполниться (в пределах misfire_grace_time) или повтор уже запланирован
+            if _job_will_run(_job_id(event_id, kind), now) or _job_will_run(f"{_job_id(event_id, kind)}_retry", now):
+                continue
+            if await db.get_reminder_recipients(event_id, kind):
+                _schedule_retry(event_id, kind, timedelta(0))
+                added += 1
+    if added:
+        logging.info(f"Восстановлено задач планировщика: {added}")
+    return added
+
+
+async def send_event_reminders(event_id, kind: str):
+    """Рассылает напоминание kind всем оплаченным заказам на мероприятие, которым оно еще не доставлено."""
+    # Основная задача и повтор не должны рассылать одно и то же одновременно
+    if (event_id, kind) in _running_fanouts:
+        logging.warning(f"Рассылка '{kind}' по мероприятию {event_id} уже идет, повторный запуск пропущен")
+        return
+    _running_fanouts.add((event_id, kind))
+    try:
+        await _send_event_reminders(event_id, kind)
+    finally:
+        _running_fanouts.discard((event_id, kind))
+
+
+async def _send_event_reminders(event_id, kind: str):
+    recipients = await db.get_reminder_recipients(event_id, kind)
+    if not recipients:
+        return
+    event = await gs.get_order_event(recipients[0])
+    if event is None:
+        logging.error(f"Не найдено мероприятие {event_id} для рассылки '{kind}'")
+        return
+
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def deliver(order):
+        async with semaphore:
+            return await _deliver(order, event, kind)
+
+    statuses = await asyncio.gather(*(deliver(order) for order in recipients))
+    sent, pending = statuses.count('sent'), statuses.count('pending')
+    logging.info(f"Рассылка '{kind}' по мероприятию {event_id}: доставлено {sent} из {len(recipients)}")
+
+    deadline = event['datetime_obj'] + REMINDERS[kind][1]
+    if pending and datetime.now() + RETRY_DELAY < deadline:
+        _schedule_retry(event_id, kind, RETRY_DELAY)
+
+
+async def _deliver(order, event: dict, kind: str) -> str:
+    """Отправляет одно напоминание и записывает результат. Возвращает статус доставки."""
+    try:
+        await _SENDERS[kind](order, event)
+    except TelegramForbiddenError as e:
+        # Пользователь заблокировал бота — повторять бесполезно
+        return await db.record_reminder_delivery(order['id'], kind, 'failed', str(e))
+    except Exception as e:
+        logging.error(f"Не удалось отправить напоминание '{kind}' по заказу #{order['id']}: {e}")
+        return await db.record_reminder_delivery(order['id'], kind, 'pending', str(e))
+    return await db.record_reminder_delivery(order['id'], kind, 'sent')
+
+
+async def _deliver_order(order_id: int, kind: str):
+    order = await _paid_order(order_id)
+    if order is None or await db.get_reminder_status(order_id, kind) in ('sent', 'failed'):
+        return
+    event = await gs.get_order_event(order)
+    if event is None:
+        logging.error(f"Не найдено мероприятие для напоминания по заказу #{order_id}")
+        return
+    await _deliver(order, event, kind)
+
+
+async def _paid_order(order_id: int):
+    order = await db.get_order_by_id(order_id)
+    if not order or order['status'] != 'paid':
+        return None
+    return order
+
+
+async def send_arrival_info(order_id: int):
+    """Отправляет инструкцию, как добраться до места, по одному заказу (если еще не отправлена)."""
+    await _deliver_order(order_id, 'arrival')
+
+
+async def request_feedback(order_id: int):
+    """Запрашивает отзыв о мероприятии по одному заказу (если еще не запрашивали)."""
+    await _deliver_order(order_id, 'feedback')
+
+
+async def _send_arrival_info(order, event: dict):
+    """
+    Отправляет инструкцию, как добраться до места. Напоминание считается доставленным,
+    как только ушел основной текст: видео и цитата — дополнения, и их ошибки только
+    логируются, чтобы повтор рассылки не присылал текст еще раз.
+    """
+    bot = _bot
+    user_id = order['user_id']
+    # Имя берем из базы, а не отдельным запросом к Telegram на каждого получателя
+    user = await db.get_user_by_id(user_id)
+    user_name = (user and (user['full_name'] or user['username'])) or ""
+    greeting = f"привет, {user_name}!🪴" if user_name else "привет!🪴"
 
     time_str = event['datetime_obj'].strftime('%H:%M')
 
     # Формируем текст с Markdown-ссылками и цитатой
     text = (
-        f"привет, {user_name}!🪴\n"
+        f"{greeting}\n"
         f"с заботой напоминаю тебе о мероприятии «{event['ShortName']}» завтра в {time_str} по адресу: Павла Андреева, 23с12\n\n"
         "мы очень просим тебя не опаздывать, чтобы не пропустить ничего интересного!\n\n"
         "чтобы быстрее найти нас, прикрепляю точку входа на территорию (нужно зайти через пункт охраны) — <a href='https://yandex.ru/maps/?whatshere%5Bzoom%5D=21&whatshere%5Bpoint%5D=37.621582,55.720705&si=5vp0w007x3hy77w2jqwfghpc64'>тут</a>\n\n"
@@ -24,35 +219,43 @@ async def send_arrival_info(bot: Bot, user_id: int, user_name: str, event: dict,
     )
 
     # Отправляем основной текст
-    await bot.send_message(user_id, text)
+    await tg.send(user_id, lambda: bot.send_message(user_id, text))
 
     # Отправляем видео
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     video_path = os.path.join(base_dir, 'arrival_video.mp4')
 
-    with open(video_path, "rb") as video_file:
-        video = BufferedInputFile(video_file.read(), filename="arrival_video.mp4")
-        await bot.send_video(user_id, video)
+    try:
+        await send_media(video_path, 'video',
+                         lambda video: tg.send(user_id, lambda: bot.send_video(user_id, video)))
+    except Exception as e:
+        logging.error(f"Не удалось отправить видеомаршрут по заказу #{order['id']}: {e}")
 
     # Отправляем текст
     quote_text = (
         "<blockquote>минутка фактов:\n"
         "мы находимся в историческом месте — бывшая территория известного парфюмерного завода «Новая Заря», основанного в 1864 году Генрихом Брокаром</blockquote>"
     )
-    await bot.send_message(user_id, quote_text, parse_mode="HTML")
+    try:
+        await tg.send(user_id, lambda: bot.send_message(user_id, quote_text, parse_mode="HTML"))
+    except Exception as e:
+        logging.error(f"Не удалось отправить цитату напоминания по заказу #{order['id']}: {e}")
 
 
-async def request_feedback(bot: Bot, user_id: int, order_id: int):
+async def _send_feedback_request(order, event: dict):
     """Запрашивает у пользователя отзыв о мероприятии."""
-    from database import get_order_by_id
     from keyboards.inline import feedback_rating_keyboard
 
-    order = await get_order_by_id(order_id)
-    # Отправляем запрос только если билет все еще активен
-    if order and order[4] == 'paid':
-        await bot.send_message(
-            user_id,
-            "привет! надеемся, тебе понравилось на нашем мероприятии\n\n"
-            "пожалуйста, оцени его от 1 до 5, это очень нам поможет!",
-            reply_markup=feedback_rating_keyboard(order_id)
-        )
\ No newline at end of file
+    user_id = order['user_id']
+    await tg.send(user_id, lambda: _bot.send_message(
+        user_id,
+        "привет! надеемся, тебе понравилось на нашем мероприятии\n\n"
+        "пожалуйста, оцени его от 1 до 5, это очень нам поможет!",
+        reply_markup=feedback_rating_keyboard(order['id'])
+    ))
+
+
+_SENDERS = {
+    'arrival': _send_arrival_info,
+    'feedback': _send_feedback_request,
+}
\ No newline at end of file